@@ -7,8 +7,8 @@
 """lazy dict-based i/o processing pipelines"""
 
 
-import sys, types, functools, errno, bisect
-import errors
+import sys, types, functools, errno, heapq, Queue, multiprocessing
+import errors, lazydict, instrument
 
 
 #--- setup logging
@@ -54,7 +54,10 @@ def processor(f):
 					kwargs[k] = v
 
 		try:
-			f2 = f(*args,**kwargs)
+			if instrument.enabled:
+				f2 = instrument.call(f, args, kwargs)
+			else:
+				f2 = f(*args,**kwargs)
 		except StopIteration:
 			#f was a source, which ran the pipeline, and StopIteration has
 			#bubbled up, which just means something down the pipeline has
@@ -65,6 +68,9 @@ def processor(f):
 			if isinstance(f2, types.GeneratorType):
 				f2.send(None)
 				return f2
+			if isinstance(f2, instrument.Stage):
+				f2.next()  #(which is not counted as a record)
+				return f2
 
 	return g
 
@@ -78,6 +84,7 @@ def restart_on_error(f):
 	This @restart_on_error decorator should be applied *before* (i.e. on a
 	lower line) than the @processor decorator.
 	"""
+	@functools.wraps(f)  #(for __doc__, and the name of the stage, see instrument)
 	def g(*args, **kwargs):
 		while True:
 			try:
@@ -93,13 +100,26 @@ def restart_on_error(f):
 	return g
 
 def suppress_epipe(f):
+	"""Decorate a sink so that it quietly stops when its output pipe breaks.
+
+	That's what happens when, e.g., the output is piped to head(1).  Errors
+	writing out anything the sink has buffered when it's closed are suppressed,
+	too.
+
+	Like @restart_on_error, this should be applied *before* the @processor
+	decorator.
+	"""
+	@functools.wraps(f)
 	def g(*args, **kwargs):
 		try:
 			f2 = f(*args, **kwargs)
 			f2.next()
-			while True:
-				d = yield
-				f2.send(d)
+			try:
+				while True:
+					d = yield
+					f2.send(d)
+			except GeneratorExit:
+				f2.close()
 		except IOError, e:
 			if e.errno != errno.EPIPE:
 				raise
@@ -117,17 +137,106 @@ def source(iterable, out=None, err=None):
 
 #--- serialization
 
-def pre_serialize(d):
-	if type(d) != dict:
-		d['__class__'] = '.'.join((d.__class__.__module__, d.__class__.__name__))
+#dicts that are not plain dicts (e.g. LazyDicts) are serialized as plain dicts
+#with their class recorded under the key __class__, as module.Class, by
+#default.  Sinks can instead be asked to use compact type ids, small integers
+#that are defined by type header records in the same stream, which look like:
+#
+#	{"__class__": "__types__", "1": "eglib.ExampleLazyDict"}
+#
+#A sink writes a header when it first sees each class, so a header always
+#comes before the records that use its ids.  Sources understand these streams
+#regardless (see post_deserialize), and each keeps its own table of ids.
+
+TYPES_HEADER = '__types__'  #the __class__ of type header records
+
+_classes = {}  #class by name, for classes that have been seen or registered
+_class_names = {}  #name by class
+
+def register_class(cls, name=None):
+	"""Register the class that deserializes records tagged with name.
+
+	The name defaults to module.Class.  This is only necessary for classes
+	that can't be imported by that name, e.g. those defined in __main__.
+	"""
+	if name is None:
+		name = '.'.join((cls.__module__, cls.__name__))
+	_classes[name] = cls
+	_class_names[cls] = name
+
+def class_name(cls):
+	"""Return the name under which records of class cls are tagged."""
+	try:
+		return _class_names[cls]
+	except KeyError:
+		name = '.'.join((cls.__module__, cls.__name__))
+		_class_names[cls] = name
+		return name
+
+def resolve_class(name):
+	"""Return the class for the given name, importing it if necessary."""
+	try:
+		return _classes[name]
+	except KeyError:
+		m, c = name.rsplit('.',1)  #assuming all subclasses are in modules
+		m = __import__(m, fromlist=[None])  #any non-empty fromlist allows importing from a package hierarchy
+		cls = _classes[name] = getattr(m, c)
+		return cls
+
+def type_header(d, types):
+	"""Return the type header record needed before d can be written, or None.
+
+	:param types: the sink's table of type ids by class, which this updates,
+		or None if the sink does not use type ids
+	"""
+	if types is None or type(d) == dict or type(d) is codec.RawRecord or d.__class__ in types:
+		return None
+	i = types[d.__class__] = len(types) + 1
+	return {'__class__': TYPES_HEADER, str(i): class_name(d.__class__)}
+
+def pre_serialize(d, types=None):
+	"""Tag d with its class, if it's not a plain dict, and return it.
+
+	:param types: the sink's table of type ids by class, if it uses them (see
+		type_header(), which must be called first)
+
+	Records that are not dicts at all (compact records, see
+	lazydict.compact()) are returned as a new, tagged dict.  Raw records (see
+	json_in) are returned as their plain, decoded dict.
+	"""
+	cls = type(d)
+	if cls != dict:
+		if cls is codec.RawRecord:
+			return d.dict()
+		if not isinstance(d, dict):
+			d = dict(d.iteritems())
+		if types is None:
+			d['__class__'] = class_name(cls)
+		else:
+			d['__class__'] = types[cls]
 	return d
 
-def post_deserialize(d):
+def post_deserialize(d, types=None):
+	"""Return d as an instance of its tagged class, if any.
+
+	:param types: the source's table of classes by type id, if it reads them
+
+	If d is a type header record, this updates types and returns None.
+	"""
 	#LBYL since optimizing for built-in dicts
 	if d.has_key('__class__'):
-		m, c = d['__class__'].rsplit('.',1)  #assuming all subclasses are in modules
-		m = __import__(m, fromlist=[None])  #any non-empty fromlist allows importing from a package hierarchy
-		d = getattr(m, c)(d)
+		c = d['__class__']
+		if types is not None:
+			if c == TYPES_HEADER:
+				for k, v in d.iteritems():
+					if k != '__class__':
+						types[int(k)] = resolve_class(v)
+				return None
+			try:
+				return types[c](d)
+			except KeyError:
+				pass
+		d = resolve_class(c)(d)
 	return d
 
 
@@ -136,54 +245,478 @@ def post_deserialize(d):
 #though these have the form of standard processors, out and err should be
 #file-like objects, not other processors.
 
+#the sinks take a type_ids option, whether or not to tag classes with compact
+#type ids rather than full names (see pre_serialize); the default sinks use
+#them if the environment variable DIO_TYPE_IDS is set
+import os
+DEFAULT_TYPE_IDS = bool(os.environ.get('DIO_TYPE_IDS'))
+
+#the json and pickle sources take a read_ahead option, whether or not to read
+#and decode on a background thread, and the sinks take a write_behind option,
+#whether or not to encode and write on one; either way, that overlaps the i/o
+#with the work of the rest of the pipeline; the default source and sink use
+#them if the environment variable DIO_THREADED_IO is set
+import threading
+DEFAULT_THREADED_IO = bool(os.environ.get('DIO_THREADED_IO'))
+DEFAULT_QUEUE_DEPTH = 16  #batches held between a background thread and the pipeline
+DEFAULT_QUEUE_BATCH = 256  #items per batch handed to or from a background thread
+_END = object()  #the end of a background thread's queue
+
+class _Stopped(Exception):
+	"""Raised in a read-ahead thread to stop it."""
+	pass
+
+def _read_ahead(read, depth=DEFAULT_QUEUE_DEPTH, batch=DEFAULT_QUEUE_BATCH):
+	"""Yield the items that read(send) sends, running it on a background thread.
+
+	At most depth batches of items are held, so the thread blocks when the
+	pipeline falls behind.  An error raised by read is raised here, in order,
+	with its traceback.  If this is closed early, the thread stops, too (once
+	it's done waiting on any input).
+	"""
+	q = Queue.Queue(depth)
+	stop = threading.Event()
+	b = []
+
+	def put(x):
+		while not stop.is_set():
+			try:
+				q.put(x, timeout=0.1)
+				return
+			except Queue.Full:
+				pass
+		raise _Stopped()
+
+	def send(x):
+		if stop.is_set():
+			raise _Stopped()
+		b.append(x)
+		if len(b) >= batch:
+			put(b[:])
+			del b[:]
+
+	def produce():
+		try:
+			try:
+				read(send)
+			except _Stopped:
+				return
+			except BaseException:
+				e = sys.exc_info()
+				if b:
+					put(b)
+				put(e)
+			else:
+				if b:
+					put(b)
+				put(_END)
+		except _Stopped:
+			pass
+
+	t = threading.Thread(target=produce)
+	t.daemon = True  #(it may be blocked reading, e.g., a terminal)
+	t.start()
+	try:
+		while True:
+			x = q.get()
+			if x is _END:
+				break
+			if type(x) is tuple:
+				raise x[0], x[1], x[2]
+			for d in x:
+				yield d
+	finally:
+		#stop it, and give it a moment to finish what it's doing, unless
+		#that's waiting on input
+		stop.set()
+		try:
+			while True:
+				q.get_nowait()
+		except Queue.Empty:
+			pass
+		t.join(0.1)
+
+class _WriteBehind(object):
+	"""Send dicts to the given sink, and close it, on a background thread.
+
+	At most depth batches of dicts are held, so send() blocks when the sink
+	falls behind.  An error raised by the sink (including the StopIteration of
+	one that's quietly stopped on EPIPE) is raised by the next send(), or else
+	by close(), and the rest of the dicts are dropped.  close() must be called
+	either way.
+	"""
+
+	def __init__(self, sink, depth=DEFAULT_QUEUE_DEPTH, batch=DEFAULT_QUEUE_BATCH):
+		self.sink = sink
+		self.batch = batch
+		self.b = []
+		self.queue = Queue.Queue(depth)
+		self.error = None
+		self.raised = False
+		self.thread = None  #(started when there's something to write)
+
+	def _put(self, b):
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._consume)
+			self.thread.daemon = True  #(it's joined when closed, which may be at exit)
+			self.thread.start()
+		self.queue.put(b)
+
+	def _consume(self):
+		while True:
+			b = self.queue.get()
+			if self.error is None:  #(otherwise, drop it)
+				try:
+					if b is _END:
+						self.sink.close()
+					else:
+						for d in b:
+							self.sink.send(d)
+				except BaseException:
+					self.error = sys.exc_info()
+			if b is _END:
+				break
+
+	def _raise(self):
+		if self.error is not None and not self.raised:
+			self.raised = True
+			e = self.error
+			raise e[0], e[1], e[2]
+
+	def send(self, d):
+		self._raise()
+		self.b.append(d)
+		if len(self.b) >= self.batch:
+			self._put(self.b)
+			self.b = []
+
+	def close(self):
+		if self.thread is None and self.error is None and not self.b:
+			self.sink.close()  #(nothing to write, so no need for the thread)
+			return
+		if self.b:
+			self._put(self.b)
+			self.b = []
+		self._put(_END)
+		self.thread.join()
+		self._raise()
+
 #repr/eval (file-like)
 import ast
 @processor
 def repr_in(inn=None, out=None, err=None):
+	types = {}
 	for line in inn:
-		out.send(post_deserialize(ast.literal_eval(line)))
+		d = post_deserialize(ast.literal_eval(line), types)
+		if d is not None:
+			out.send(d)
 @processor
 @suppress_epipe
-def repr_out(out=None, err=None):
+def repr_out(out=None, err=None, type_ids=False):
+	types = {} if type_ids else None
 	while True:
 		d = yield
-		out.write(repr(pre_serialize(d))+'\n')
+		h = type_header(d, types)
+		if h is not None:
+			out.write(repr(h)+'\n')
+		out.write(repr(pre_serialize(d, types))+'\n')
 
 #pickle (file-like)
 import cPickle
-@processor
-def pickle_in(inn=None, out=None, err=None):
+def _pickle_read(inn, send):
+	types = {}
 	while True:
 		try:
-			out.send(post_deserialize(cPickle.load(inn)))
+			d = post_deserialize(cPickle.load(inn), types)
 		except EOFError:
 			break
+		if d is not None:
+			send(d)
+@processor
+def pickle_in(inn=None, read_ahead=False, out=None, err=None):
+	"""like other sources, inn should be a file-like object
+
+	If read_ahead is True, the input is read and decoded on a background
+	thread (see DEFAULT_THREADED_IO).
+	"""
+	if not read_ahead:
+		_pickle_read(inn, out.send)
+		return
+	records = _read_ahead(lambda send: _pickle_read(inn, send))
+	try:
+		for d in records:
+			out.send(d)
+	finally:
+		records.close()  #(to stop the thread if out stops early)
 @processor
 @suppress_epipe
-def pickle_out(out=None, err=None):
-	"""like other sinks, out and err should be file-like objects"""
+def pickle_out(out=None, err=None, type_ids=False, write_behind=False):
+	"""like other sinks, out and err should be file-like objects
+
+	If write_behind is True, the dicts are encoded and written on a background
+	thread (see DEFAULT_THREADED_IO), so they must not be modified once sent.
+	"""
+	if write_behind:
+		w = _WriteBehind(pickle_out(out=out, type_ids=type_ids))
+		try:
+			while True:
+				w.send((yield))
+		finally:
+			w.close()
+
+	types = {} if type_ids else None
 	while True:
 		d = yield
-		cPickle.dump(pre_serialize(d), out)
+		h = type_header(d, types)
+		if h is not None:
+			cPickle.dump(h, out)
+		cPickle.dump(pre_serialize(d, types), out)
 
 #json (file-like)
-import json
-@processor
-def json_in(inn=sys.stdin, out=None, err=None):
+import codec
+DEFAULT_WRITE_BUFFER_SIZE = 64*1024  #bytes json_out collects before writing
+def _json_read(inn, intern_keys, raw, send):
+	decode = codec.decode_interned if intern_keys else codec.decode
+	RawRecord = codec.RawRecord
+	types = {}
 	for line in inn:
+		if raw and '"__class__"' not in line:
+			if not line.isspace():
+				send(RawRecord(line))
+			continue
 		try:
-			out.send(post_deserialize(json.loads(line)))
+			d = post_deserialize(decode(line), types)
 		except ValueError:
 			if line.strip()!='':
 				raise
+		else:
+			if d is not None:
+				send(d)
+@processor
+def json_in(inn=sys.stdin, intern_keys=False, raw=False, read_ahead=False, out=None, err=None):
+	"""like other sources, inn should be a file-like object
+
+	If intern_keys is True, the dicts share their key strings (see
+	codec.decode_interned), which saves memory when many are kept.
+
+	If raw is True, plain dicts are output as codec.RawRecords, which are only
+	decoded if used, and which json_out writes as is if they're not modified.
+	Lines of LazyDicts and such (those with a __class__) are decoded as usual.
+
+	If read_ahead is True, the input is read and decoded on a background
+	thread (see DEFAULT_THREADED_IO).
+	"""
+	if not read_ahead:
+		_json_read(inn, intern_keys, raw, out.send)
+		return
+	records = _read_ahead(lambda send: _json_read(inn, intern_keys, raw, send))
+	try:
+		for d in records:
+			out.send(d)
+	finally:
+		records.close()  #(to stop the thread if out stops early)
+
+#json, from a file on disk, parsed in parallel
+import mmap
+DEFAULT_PARSE_CHUNK_SIZE = 4*1024*1024  #bytes per json_file_in work unit
+class _Window(object):
+	"""An iterable over items that holds back once size of them are out.
+
+	This is for feeding a multiprocessing.Pool's imap(), which otherwise
+	submits all the items at once, and keeps all the results that are not yet
+	consumed; call release() for each result consumed, and stop() when done.
+	"""
+	def __init__(self, items, size):
+		self.items = items
+		self.slots = threading.Semaphore(size)
+		self.stopped = False
+	def __iter__(self):
+		for x in self.items:
+			self.slots.acquire()
+			if self.stopped:
+				return
+			yield x
+	def release(self):
+		self.slots.release()
+	def stop(self):
+		self.stopped = True
+		self.slots.release()  #(in case it's waiting)
+def _json_ranges(path, chunk_size):
+	"""Return (start, stop) byte ranges of path, split at newlines."""
+	f = open(path, 'rb')
+	try:
+		size = os.fstat(f.fileno()).st_size
+		if size == 0:
+			return []  #(a zero-length file can't be mapped)
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			ranges = []
+			start = 0
+			while start < size:
+				stop = m.find('\n', min(start + chunk_size, size) - 1)
+				stop = size if stop == -1 else stop + 1
+				ranges.append((start, stop))
+				start = stop
+			return ranges
+		finally:
+			m.close()
+	finally:
+		f.close()
+def _json_parse_range(args):
+	"""Return (i, the list of decoded dicts) for a (path, start, stop, i) range.
+
+	The dicts are still in their serialized form.  This runs in the worker
+	processes.
+	"""
+	path, start, stop, i = args
+	f = open(path, 'rb')
+	try:
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			lines = m[start:stop].split('\n')
+		finally:
+			m.close()
+	finally:
+		f.close()
+	decode = codec.decode
+	return i, [ decode(line) for line in lines if line.strip() != '' ]
+@processor
+def json_file_in(path, workers=None, ordered=True, chunk_size=DEFAULT_PARSE_CHUNK_SIZE, out=None, err=None):
+	"""Read dicts from the JSON-lines file at path, parsing it in parallel.
+
+	:param workers: the number of processes with which to parse, or 0 to parse
+		in this process (default: the number of CPUs)
+	:param ordered: whether to output dicts in file order (True) or a chunk at
+		a time as they're parsed (False), e.g. for reducers
+	:param chunk_size: the approximate number of bytes each process parses at
+		a time; chunks are split at newlines
+
+	The file is memory-mapped, so it must be a regular file, not a pipe.  At
+	most twice as many chunks as workers are parsed but not yet output at a
+	time.  Type ids are resolved in the parent, in file order, so that each
+	record gets the class its id had where it is in the file (e.g. in files
+	that are several, concatenated); when unordered, the records of a chunk
+	that have type ids are held until all the chunks before it have been
+	parsed.
+	"""
+	ranges = [ (path, start, stop, i) for i, (start, stop) in enumerate(_json_ranges(path, chunk_size)) ]
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if workers > 0:
+		pool = multiprocessing.Pool(workers)
+		window = _Window(ranges, 2*workers)
+		if ordered:
+			chunks = pool.imap(_json_parse_range, window)
+		else:
+			chunks = pool.imap_unordered(_json_parse_range, window)
+	else:
+		pool = None
+		window = None
+		chunks = ( _json_parse_range(r) for r in ranges )
+
+	types = {}  #type ids as of the end of the last chunk resolved
+	def emit(d):
+		d = post_deserialize(d, types)
+		if d is not None:
+			out.send(d)
+
+	#when unordered, the chunks are resolved in file order, the records of
+	#each that need the type ids (those with them, and the type headers) held
+	#until all the chunks before it have been
+	held = {}  #those records, by chunk
+	resolved = [0]  #the number of chunks resolved
+	def resolve():
+		while resolved[0] in held:
+			for d in held.pop(resolved[0]):
+				emit(d)
+			resolved[0] += 1
+			if window is not None:
+				window.release()
+
+	try:
+		for i, chunk in chunks:
+			if ordered:
+				for d in chunk:
+					emit(d)
+				resolved[0] += 1
+				if window is not None:
+					window.release()
+				continue
+
+			typed = []
+			for d in chunk:
+				c = d.get('__class__')
+				if isinstance(c, int) or c == TYPES_HEADER:
+					typed.append(d)
+				else:
+					emit(d)
+			held[i] = typed
+			resolve()
+	finally:
+		if window is not None:
+			window.stop()
+		if pool is not None:
+			pool.terminate()
+
 @processor
 @suppress_epipe
-def json_out(out=None, err=None):
-	"""like other sinks, out and err should be file-like objects"""
-	while True:
-		d = yield
-		json.dump(pre_serialize(d), out)
-		out.write('\n')
+def json_out(out=None, err=None, buffer_size=None, type_ids=False, write_behind=False):
+	"""like other sinks, out and err should be file-like objects
+
+	Output is collected and written about buffer_size bytes at a time, and
+	when the sink is closed.  By default, that's DEFAULT_WRITE_BUFFER_SIZE, or
+	0 (i.e. each dict is written right away) if out is a terminal.
+
+	If write_behind is True, the dicts are encoded and written on a background
+	thread (see DEFAULT_THREADED_IO), so they must not be modified once sent.
+	"""
+	if buffer_size is None:
+		try:
+			interactive = out.isatty()
+		except AttributeError:
+			interactive = False
+		buffer_size = 0 if interactive else DEFAULT_WRITE_BUFFER_SIZE
+
+	if write_behind:
+		w = _WriteBehind(json_out(out=out, buffer_size=buffer_size, type_ids=type_ids),
+			batch=DEFAULT_QUEUE_BATCH if buffer_size else 1,
+		)
+		try:
+			while True:
+				w.send((yield))
+		finally:
+			w.close()
+
+	encode = codec.encode
+	RawRecord = codec.RawRecord
+	types = {} if type_ids else None
+	buf = []
+	size = 0
+	try:
+		while True:
+			d = yield
+			if type(d) is RawRecord and d._line is not None:
+				#unmodified, so write the original line
+				s = d._line
+				if s.endswith('\n'):
+					s = s[:-1]
+			else:
+				h = type_header(d, types)
+				if h is not None:
+					buf.append(encode(h))
+					buf.append('\n')
+				s = encode(pre_serialize(d, types))
+			buf.append(s)
+			buf.append('\n')
+			size += len(s) + 1
+			if size >= buffer_size:
+				out.write(''.join(buf))
+				buf = []
+				size = 0
+	except GeneratorExit:
+		if buf:
+			out.write(''.join(buf))
 
 #buffers (iterable/appendable)
 @processor
@@ -200,13 +733,97 @@ def buffer_out(out=None, err=None):
 
 #--- default i/o source and sinks
 #these are intended to be changed, if desired, at the beginning of a pipeline
-default_in = json_in
-default_out = json_out(out=sys.stdout)
-default_err = json_out(out=sys.stderr)
+default_in = json_in if not DEFAULT_THREADED_IO else functools.partial(json_in, read_ahead=True)
+default_out = json_out(out=sys.stdout, type_ids=DEFAULT_TYPE_IDS, write_behind=DEFAULT_THREADED_IO)
+default_err = json_out(out=sys.stderr, buffer_size=0, type_ids=DEFAULT_TYPE_IDS)
+
+#the defaults live until the end, so close them then, so that anything they've
+#buffered gets written; pipeline statistics, if any, are sent to default_err
+#(see instrument) once default_out's final writes have been counted
+import atexit
+def _close_defaults():
+	for f in (default_out, default_err):
+		if f is default_err and instrument.enabled:
+			instrument.emit()
+		try:
+			f.close()
+		except AttributeError:
+			pass
+atexit.register(_close_defaults)
+
+
+#--- sorting
+
+class _Descending(object):
+	"""A sort key value wrapper that reverses the order of the values."""
+	__slots__ = ('v',)
+	def __init__(self, v):
+		self.v = v
+	def __lt__(self, other):
+		return other.v < self.v
+	def __le__(self, other):
+		return other.v <= self.v
+	def __gt__(self, other):
+		return other.v > self.v
+	def __ge__(self, other):
+		return other.v >= self.v
+	def __eq__(self, other):
+		return other.v == self.v
+	def __ne__(self, other):
+		return other.v != self.v
+
+def sortkey(keys=(), reverse=False):
+	"""Return a callable that returns the sort key for a given dict.
+
+	:param keys: the keys to sort by, in order of precedence; each is either
+		a key, or a tuple (key, reverse) to sort by that key in the given
+		direction
+	:param reverse: whether to reverse the direction of all the keys
+
+	If there are no keys, the dicts are assumed to be one-item, and are sorted
+	by that value regardless of key.  The sort keys are tuples, and sorting by
+	them is stable, as usual.
+	"""
+	if len(keys) == 0:
+		if reverse:
+			return lambda d: (_Descending(d.itervalues().next()),)
+		return lambda d: (d.itervalues().next(),)
+
+	spec = []  #(key, reverse) for each key
+	for k in keys:
+		if isinstance(k, tuple):
+			k, r = k
+		else:
+			r = False
+		spec.append((k, bool(r) != bool(reverse)))
+
+	if not any(r for k, r in spec):
+		keys = [ k for k, r in spec ]
+		return lambda d: tuple([ d[k] for k in keys ])
+	return lambda d: tuple([ (_Descending(d[k]) if r else d[k]) for k, r in spec ])
 
 
 #--- common constructs
 
+#the per-record work of some of the constructs below, shared with their
+#batch-mode counterparts in dio.batch
+
+def _tidy(d, keys):
+	for k in keys:
+		#EAFP since assuming caller expects these keys
+		try:
+			d[k]  #trigger any extensions needed to compute it
+		except KeyError:
+			pass
+	for k in set(d.keys()) - keys:
+		d.pop(k, None)  #(the key will always be there, but it not being there is not an error per se)
+	return d
+
+def _strip(d, keys):
+	for k in keys:
+		d.pop(k, None)
+	return d
+
 @processor
 @restart_on_error
 def identity(out=None, err=None):
@@ -261,15 +878,7 @@ def tidy(keys, out=None, err=None):
 	keys = set(keys)
 	while True:
 		d = yield
-		for k in keys:
-			#EAFP since assuming caller expects these keys
-			try:
-				d[k]  #trigger any extensions needed to compute it
-			except KeyError:
-				pass
-		for k in set(d.keys()) - keys:
-			d.pop(k, None)  #(the key will always be there, but it not being there is not an error per se)
-		out.send(d)
+		out.send(_tidy(d, keys))
 
 @processor
 @restart_on_error
@@ -288,139 +897,428 @@ def strip(keys, out=None, err=None):
 	keys = set(keys)
 	while True:
 		d = yield
-		for k in keys:
-			d.pop(k, None)
-		out.send(d)
-
+		out.send(_strip(d, keys))
 
-#--- common reducers
 
 @processor
-def count(out=None, err=None):
-	"""Count appearances of each key."""
-	result = {}
+def prefetch(keys, batch_size=1000, out=None, err=None):
+	"""Compute the given keys for LazyDicts in batches, and pass them on.
+
+	:param: keys: the keys to compute
+	:type: keys: an iterable
+	:param: batch_size: the number of dicts to buffer and compute at once
+
+	Extensions are run with one Extension.call_batch() per batch rather than
+	one call per dict (see lazydict.prefetch), which is a big win for
+	extensions with per-call latency, like database lookups.  Dicts are passed
+	on in input order.  Having all the given keys is not required, and dicts
+	that are not LazyDicts are passed through untouched.
+	"""
+	keys = tuple(keys)
+
+	buf = []
+	def flush():
+		try:
+			lazydict.prefetch(buf, keys)
+		except Exception, e:
+			#the dicts can still be extended on demand later on
+			err.send(errors.e2d(e))
+		for d in buf:
+			out.send(d)
+
 	try:
 		while True:
 			d = yield
-			for k, v in d.iteritems():
-				result[k] = result.get(k,0) + 1
+			buf.append(d)
+			if len(buf) >= batch_size:
+				flush()
+				buf = []
 	except GeneratorExit:
-		for i in result.iteritems():
-			out.send(dict((i,)))
+		if buf:
+			flush()
 
-@processor
-def sum_(out=None, err=None):
-	"""Sum values for each key."""
-	result = {}
+
+#--- concurrency
+
+import collections, multiprocessing.dummy
+
+def _extend_keys(d, keys):
+	"""Get the given keys of d, for concurrent_extend.
+
+	:returns: d and, if there was an error, the error as a dio dict (else None)
+	"""
 	try:
-		while True:
-			d = yield
-			for k, v in d.iteritems():
-				result[k] = result.get(k,0) + v
-	except GeneratorExit:
-		for i in result.iteritems():
-			out.send(dict((i,)))
+		for k in keys:
+			try:
+				d[k]  #trigger any extensions needed to compute it
+			except KeyError:
+				pass
+	except Exception, e:
+		return d, errors.e2d(e)
+	return d, None
 
 @processor
-def average(out=None, err=None):
-	"""Sum values for each key."""
-	counts = {}  #for each key, Σ1 for all values v for that key
-	sums = {}  #for each key, Σv for all values v for that key
-	sums_sqs = {}  #for each key, Σ(v²) for all values v for that key
+def concurrent_extend(keys, workers=4, window=None, ordered=True, out=None, err=None):
+	"""Get the given keys of input dicts on a thread pool, and pass them on.
+
+	:param: keys: the keys to compute
+	:type: keys: an iterable
+	:param: workers: the number of threads
+	:param: window: the maximum number of dicts in flight at once (default:
+		four per worker)
+	:param: ordered: whether to output dicts in input order (True) or in order
+		of completion (False)
+
+	This is for LazyDicts with I/O-bound extensions -- the latency of the
+	extensions for different dicts overlaps rather than stalling the pipeline
+	once per dict.  Each dict is extended by one thread, as usual (i.e.
+	honoring its laziness and overwrite settings), and having all the given
+	keys is not required.  A dict whose extensions raise an error is not
+	passed on; the error is sent to err instead.
+	"""
+	keys = tuple(keys)
+	if window is None:
+		window = 4*workers
+
+	pool = multiprocessing.dummy.Pool(workers)
+
+	if ordered:
+		pending = collections.deque()
+		submit = lambda d: pending.append(pool.apply_async(_extend_keys, (d, keys)))
+		result = lambda: pending.popleft().get()
+	else:
+		pending = Queue.Queue()
+		submit = lambda d: pool.apply_async(_extend_keys, (d, keys), callback=pending.put)
+		result = pending.get
+
+	in_flight = 0
+	def emit():
+		d, e = result()
+		if e is None:
+			out.send(d)
+		else:
+			err.send(e)
+
 	try:
-		while True:
-			d = yield
-			for k, v in d.iteritems():
-				counts[k] = counts.get(k,0) + 1
-				sums[k] = sums.get(k,0) + v
-				sums_sqs[k] = sums_sqs.get(k,0) + v**2
-	except GeneratorExit:
-		count = len(sums)
-		##2.6 doesn't have dict comprehensions
-		#averages = { k: float(v)/counts[k] for k, v in sums.iteritems() }
-		averages = dict((k,float(v)/counts[k]) for k, v in sums.iteritems())
-		for i in averages.iteritems():
-			out.send(dict((i,)))
+		try:
+			while True:
+				d = yield
+				submit(d)
+				in_flight += 1
+				if in_flight >= window:
+					in_flight -= 1
+					emit()
+		except GeneratorExit:
+			while in_flight > 0:
+				in_flight -= 1
+				emit()
+	finally:
+		pool.terminate()
+
+
+#--- parallelism
+
+def _to_wire(ds):
+	"""Convert dicts to plain, class-tagged dicts to send between processes."""
+	return [ d if type(d) is dict else dict(pre_serialize(d)) for d in ds ]
+
+def _from_wire(ds):
+	"""The inverse of _to_wire."""
+	return [ post_deserialize(d) for d in ds ]
+
+def _portable(e):
+	"""Return exception e, or a stand-in for it if it can't be pickled."""
+	try:
+		cPickle.dumps(e, 2)
+		return e
+	except Exception:
+		return RuntimeError('%s: %s' % (e.__class__.__name__, e))
+
+def _parallel_worker(stage_factory, i, inq, outq):
+	"""The body of each dio.parallel worker process.
+
+	This reads (seq, chunk) items from inq until it gets None, sends each
+	chunk through its own copy of the sub-pipeline, and puts (seq, i, outs,
+	errs, done, failure) on outq for each, where done is whether the
+	sub-pipeline has stopped accepting input, and failure is the exception it
+	raised, if any (which is reported once; the parent stops on it).  After
+	closing the sub-pipeline, it puts a final item with a seq of None.
+	"""
+	outs = []
+	errs = []
 
-@processor
-def min_(n, key, out=None, err=None):
-	"""Emit the n dicts with the max values for key.
+	done = False
+	failure = None
+	try:
+		stage = stage_factory(out=buffer_out(out=outs), err=buffer_out(out=errs))
+	except Exception, e:
+		failure = _portable(e)
+		done = True
+
+	while True:
+		item = inq.get()
+		if item is None:
+			break
+		seq, chunk = item
+		if not done:
+			try:
+				for d in _from_wire(chunk):
+					stage.send(d)
+			except StopIteration:
+				done = True
+			except Exception, e:
+				failure = _portable(e)
+				done = True
+		outq.put((seq, i, _to_wire(outs), _to_wire(errs), done, failure))
+		del outs[:]
+		del errs[:]
+		failure = None
+
+	if not done:
+		try:
+			stage.close()
+		except Exception, e:
+			failure = _portable(e)
+	outq.put((None, i, _to_wire(outs), _to_wire(errs), True, failure))
 
-	The results are currently in sorted order, but that may change back to
-	input order in the future.
+@processor
+def parallel(stage_factory, workers=4, ordered=True, chunk_size=100, out=None, err=None):
+	"""Run a sub-pipeline in several worker processes.
+
+	:param: stage_factory: a callable that accepts out and err keyword
+		arguments and returns the first stage of the sub-pipeline, e.g.
+		functools.partial(dio.tidy, keys); it's called in each worker
+	:param: workers: the number of worker processes
+	:param: ordered: whether to output results in input order (True) or as
+		they come back (False)
+	:param: chunk_size: the number of dicts to send to a worker at once
+
+	Input dicts are dealt out in chunks to whichever worker is free.  Each
+	worker has its own copy of the sub-pipeline, so stateful stages, like
+	reducers, see only their share of the input and emit their results when
+	closed (after all other results); see the partial modes of the reducers
+	for combining those.  Dicts cross process boundaries in the usual
+	pre_serialize()/post_deserialize() form, and anything the sub-pipelines
+	send to err is sent on to err.
+
+	If the rest of the pipeline stops early (e.g. coreutils.head), the workers
+	are terminated.  If all the sub-pipelines stop early, this stops, too.  If
+	a sub-pipeline raises an error (rather than sending it to err, as, e.g.,
+	@restart_on_error stages do), the results before it are output, and then
+	this raises it, too, as it would if the sub-pipeline were run in one
+	process, and the workers are terminated.
 	"""
-	#FIXME replace this by an efficient algorithm / data structure, like a
-	#binary tree.  The insert/pop operations below are O(n) on result set size
-	#(but at least result set size does not scale with input size).
+	inq = multiprocessing.Queue()
+	outq = multiprocessing.Queue()
+	procs = []
+	for i in xrange(workers):
+		p = multiprocessing.Process(target=_parallel_worker, args=(stage_factory, i, inq, outq))
+		p.daemon = True
+		p.start()
+		procs.append(p)
+
+	state = {
+		'sent': 0,  #number of chunks sent (also the seq of the next one)
+		'received': 0,  #number of chunk results received
+		'next': 0,  #the seq of the next chunk to output, if ordered
+		'done': set(),  #the workers whose sub-pipelines have stopped
+	}
+	pending = {}  #results received out of order, by seq
+	finals = {}  #results of closing the sub-pipelines, by worker
+
+	def emit(outs, errs, failure):
+		for d in _from_wire(errs):
+			err.send(d)
+		for d in _from_wire(outs):
+			out.send(d)
+		if failure is not None:
+			raise failure
 
-	#NOTE -- keep this code in sync with max_!!! (probably should be combined)
+	def receive(block):
+		"""Receive and output one result; return False if none was ready."""
+		try:
+			seq, i, outs, errs, done, failure = outq.get(block)
+		except Queue.Empty:
+			return False
+		if done:
+			state['done'].add(i)
+		if seq is None:
+			finals[i] = (outs, errs, failure)
+			return True
+		state['received'] += 1
+		if not ordered:
+			emit(outs, errs, failure)
+		else:
+			pending[seq] = (outs, errs, failure)
+			while state['next'] in pending:
+				emit(*pending.pop(state['next']))
+				state['next'] += 1
+		return True
+
+	def send(chunk):
+		inq.put((state['sent'], chunk))
+		state['sent'] += 1
+		#output whatever is ready, and don't get too far ahead of the workers
+		while receive(False):
+			pass
+		while state['sent'] - state['received'] > 2*workers:
+			receive(True)
+
+	chunk = []
+	try:
+		try:
+			while len(state['done']) < workers:
+				d = yield
+				chunk.append(d)
+				if len(chunk) >= chunk_size:
+					send(_to_wire(chunk))
+					chunk = []
+		except GeneratorExit:
+			if chunk:
+				send(_to_wire(chunk))
+		for p in procs:
+			inq.put(None)
+		while len(finals) < workers:
+			receive(True)
+		for i in sorted(finals):
+			emit(*finals[i])
+		for p in procs:
+			p.join()
+	finally:
+		for p in procs:
+			if p.is_alive():
+				p.terminate()
 
-	results_d = []  #list of result d
-	results_v = []  #list of d[key] for the results
 
-	bubble_value = None  #the current threshold value (inside the bubble)
+#--- common reducers
 
+#count, sum_, and average can run in partial mode, where instead of final
+#results they emit their intermediate state, for each key k, as {k: state},
+#where state is a dict of the running totals named below.  In combine mode,
+#they take such partial state as input (e.g. from reducers that each ran over
+#a shard of the data) and merge it.  Both at once does a partial combination.
+#This makes it possible to run the reducers in parallel and combine the
+#results cheaply.
+
+_reducer_fields = {
+	'count': lambda v: 1,  #Σ1 for all values v for that key
+	'sum': lambda v: v,  #Σv for all values v for that key
+	'sum_sq': lambda v: v**2,  #Σ(v²) for all values v for that key
+}
+
+def _reducer(fields, finish, partial, combine, out):
+	"""The coroutine that does the work of count, sum_, and average.
+
+	:param fields: the names of the running totals to keep for each key
+	:param finish: a callable that accepts the state for a key and returns the
+		final value for it
+	"""
+	totals = [ (f, _reducer_fields[f], {}) for f in fields ]
 	try:
 		while True:
 			d = yield
-			v = d[key]
-
-			if v < bubble_value or bubble_value is None:
-				#insert the new value
-				pos = bisect.bisect_left(results_v, v)
-				results_d.insert(pos, d)
-				results_v.insert(pos, v)
-
-				#remove the old bubble value (if necessary)
-				if len(results_v) > n:
-					pos = bisect.bisect_right(results_v, bubble_value)
-					results_d.pop()
-					results_v.pop()
-
-					#set the new bubble value
-					bubble_value = results_v[-1]
+			if combine:
+				for k, state in d.iteritems():
+					for f, g, t in totals:
+						t[k] = t.get(k,0) + state[f]
+			else:
+				for k, v in d.iteritems():
+					for f, g, t in totals:
+						t[k] = t.get(k,0) + g(v)
 	except GeneratorExit:
-		for d in results_d:
-			out.send(d)
+		for k in totals[0][2].keys():
+			state = dict((f, t[k]) for f, g, t in totals)
+			if partial:
+				out.send({k: state})
+			else:
+				out.send({k: finish(state)})
 
 @processor
-def max_(n, key, out=None, err=None):
-	"""Emit the n dicts with the max values for key.
+def count(partial=False, combine=False, out=None, err=None):
+	"""Count appearances of each key.
 
-	The results are currently in sorted order, but that may change back to
-	input order in the future.
+	See above for partial and combine.
 	"""
+	return _reducer(('count',), lambda state: state['count'], partial, combine, out)
 
-	#FIXME replace this by an efficient algorithm / data structure, like a
-	#binary tree.  The insert/pop operations below are O(n) on result set size
-	#(but at least result set size does not scale with input size).
+@processor
+def sum_(partial=False, combine=False, out=None, err=None):
+	"""Sum values for each key.
 
-	#NOTE -- keep this code in sync with min_!!! (probably should be combined)
+	See above for partial and combine.
+	"""
+	return _reducer(('sum',), lambda state: state['sum'], partial, combine, out)
 
-	results_d = []  #list of result d
-	results_v = []  #list of d[key] for the results
+@processor
+def average(partial=False, combine=False, out=None, err=None):
+	"""Average values for each key.
 
-	bubble_value = None  #the current threshold value (inside the bubble)
+	See above for partial and combine.  The partial state includes the sum of
+	squares, too, so that the spread of the values can be derived from it.
+	"""
+	return _reducer(('count', 'sum', 'sum_sq'), lambda state: float(state['sum'])/state['count'], partial, combine, out)
 
+def _top(n, keys, reverse, ties, order, out):
+	"""The coroutine that does the work of top, min_, and max_."""
+	if ties not in ('first', 'last'):
+		raise ValueError("ties must be 'first' or 'last', not %r" % ties)
+	if order not in ('sorted', 'input'):
+		raise ValueError("order must be 'sorted' or 'input', not %r" % order)
+
+	keyf = sortkey(keys, reverse)
+	tiebreak = (ties == 'first') and -1 or 1
+
+	#a min-heap of (key, tiebreaker, seq, d), so the root is the worst of the
+	#best so far; the tiebreaker makes the preferred of equals greater
+	heap = []
+
+	seq = 0
 	try:
 		while True:
 			d = yield
-			v = d[key]
-
-			if v > bubble_value or bubble_value is None:
-				#insert the new value
-				pos = bisect.bisect_right(results_v, v)
-				results_d.insert(pos, d)
-				results_v.insert(pos, v)
-
-				#remove the old bubble value (if necessary)
-				if len(results_v) > n:
-					pos = bisect.bisect_left(results_v, bubble_value)
-					results_d.pop(0)
-					results_v.pop(0)
-
-					#set the new bubble value
-					bubble_value = results_v[0]
+			entry = (keyf(d), tiebreak*seq, seq, d)
+			seq += 1
+			if len(heap) < n:
+				heapq.heappush(heap, entry)
+			elif n > 0 and entry > heap[0]:
+				heapq.heapreplace(heap, entry)
 	except GeneratorExit:
-		for d in results_d:
-			out.send(d)
+		if order == 'sorted':
+			heap.sort(reverse=True)
+		else:
+			heap.sort(key=lambda entry: entry[2])
+		for entry in heap:
+			out.send(entry[3])
+
+@processor
+def top(n, keys=(), reverse=False, ties='first', order='sorted', out=None, err=None):
+	"""Emit the n dicts with the greatest values for the given keys.
+
+	:param n: the number of dicts to emit
+	:param keys, reverse: as for dio.sortkey; reverse=True emits the n dicts
+		with the least values, and keys can have different directions
+	:param ties: which dicts to prefer among those with equal values, 'first'
+		(those that came first) or 'last'
+	:param order: the order in which to emit the dicts, 'sorted' (the
+		greatest, or least if reversed, first) or 'input'
+
+	This keeps a heap of the n best so far, so each input dict costs at most
+	O(log n).
+	"""
+	return _top(n, keys, reverse, ties, order, out)
+
+@processor
+def min_(n, key, out=None, err=None):
+	"""Emit the n dicts with the min values for key, least first.
+
+	See top() for more options.
+	"""
+	return _top(n, (key,), True, 'first', 'sorted', out)
+
+@processor
+def max_(n, key, out=None, err=None):
+	"""Emit the n dicts with the max values for key, greatest first.
+
+	See top() for more options.
+	"""
+	return _top(n, (key,), False, 'first', 'sorted', out)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""batch mode -- processors that send and receive lists of dicts
+
+Every send() from one stage to the next costs a generator switch, and the
+@restart_on_error and @suppress_epipe wrappers each add another.  In batch
+mode, the unit passed between stages is a list of dicts rather than a single
+dict, so that overhead is paid once per batch instead of once per record.
+
+The processors here mirror the common constructs in dio, but each send carries
+a list.  To mix them with per-record processors, use the adapters:
+
+	batch()    per-record in, batches out
+	unbatch()  batches in, per-record out
+	each()     runs a per-record processor on every record of every batch
+
+For example, this tidies and filters in batch mode, uses dio.coreutils.uniq
+(which is per-record only) through each(), and ends in the per-record
+default_out:
+
+	dio.batch.source(iterable,
+		out=dio.batch.tidy(('x',),
+			out=dio.batch.filter(lambda d: d['x'] > 10,
+				out=dio.batch.each(dio.coreutils.uniq,
+					out=dio.batch.unbatch()
+				)
+			)
+		)
+	)
+
+Rather than using @restart_on_error, which would throw away the rest of a
+batch, these processors catch errors per record, send them to err, and carry on
+with the rest of the batch.  Empty batches are never sent.
+"""
+
+
+import itertools
+
+from dio import processor, errors, buffer_out, _tidy, _strip
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+#--- sources
+
+@processor
+def source(iterable, size=DEFAULT_BATCH_SIZE, out=None, err=None):
+	"""Turn any iterable of dicts into a source of batches of them."""
+	iterable = iter(iterable)
+	while True:
+		b = list(itertools.islice(iterable, size))
+		if not b:
+			break
+		out.send(b)
+
+
+#--- adapters
+
+@processor
+def batch(size=DEFAULT_BATCH_SIZE, out=None, err=None):
+	"""Group input dicts into batches of the given size.
+
+	The last batch, sent when this is closed, may be smaller.
+	"""
+	b = []
+	try:
+		while True:
+			d = yield
+			b.append(d)
+			if len(b) >= size:
+				out.send(b)
+				b = []
+	except GeneratorExit:
+		if b:
+			out.send(b)
+
+@processor
+def unbatch(out=None, err=None):
+	"""Send each dict of each input batch individually."""
+	while True:
+		b = yield
+		for d in b:
+			out.send(d)
+
+@processor
+def each(factory, *args, **kwargs):
+	"""Run a per-record processor over batches.
+
+	:param factory: a per-record processor, e.g. dio.tidy
+	:param args, kwargs: the arguments with which to create it (other than out
+		and err)
+
+	Each record of each input batch is sent to the per-record processor, and
+	whatever it outputs in response is sent on as a batch.  Anything it outputs
+	when closed (e.g. the results of a reducer) is sent on as a final batch.
+	"""
+	out = kwargs.pop('out')
+	err = kwargs.pop('err')
+
+	results = []
+	inner = factory(*args, out=buffer_out(out=results), err=err, **kwargs)
+	try:
+		while True:
+			b = yield
+			try:
+				for d in b:
+					inner.send(d)
+			except StopIteration:
+				#the inner processor is done (e.g. coreutils.head); pass on
+				#what it has produced and be done, too
+				if results:
+					out.send(results[:])
+				break
+			if results:
+				out.send(results[:])
+				del results[:]
+	except GeneratorExit:
+		inner.close()
+		if results:
+			out.send(results[:])
+
+
+#--- common constructs
+
+@processor
+def identity(out=None, err=None):
+	"""Output all input batches."""
+	while True:
+		b = yield
+		out.send(b)
+
+@processor
+def filter(f, out=None, err=None):
+	"""Output the dicts d of each input batch for which f(d) is True.
+
+	:param f: a callable that accepts a single input dict and returns the
+		boolean of whether or not to send the given dict.
+
+	If f has a select attribute, a callable that accepts a whole batch and
+	returns the list of dicts to send (e.g. see dio.condition), it's used
+	instead, and f is only used for batches where select raises an error.
+	"""
+	select = getattr(f, 'select', None)
+	while True:
+		b = yield
+		b2 = None
+		if select is not None:
+			try:
+				b2 = select(b)
+			except Exception:
+				pass  #(redo it one at a time, to find the errors)
+		if b2 is None:
+			b2 = []
+			for d in b:
+				try:
+					if f(d): b2.append(d)
+				except Exception, e:
+					err.send(errors.e2d(e))
+		if b2:
+			out.send(b2)
+
+@processor
+def apply(f, out=None, err=None):
+	"""For each dict d of each input batch, output all f(d).
+
+	:param f: a callable that accepts a single input dict and yields zero or
+		more output dicts.
+	"""
+	while True:
+		b = yield
+		b2 = []
+		for d in b:
+			try:
+				b2.extend(f(d))
+			except Exception, e:
+				err.send(errors.e2d(e))
+		if b2:
+			out.send(b2)
+
+@processor
+def tidy(keys, out=None, err=None):
+	"""The batch-mode dio.tidy."""
+	keys = set(keys)
+	while True:
+		b = yield
+		b2 = []
+		for d in b:
+			try:
+				b2.append(_tidy(d, keys))
+			except Exception, e:
+				err.send(errors.e2d(e))
+		if b2:
+			out.send(b2)
+
+@processor
+def strip(keys, out=None, err=None):
+	"""The batch-mode dio.strip."""
+	keys = set(keys)
+	while True:
+		b = yield
+		b2 = []
+		for d in b:
+			try:
+				b2.append(_strip(d, keys))
+			except Exception, e:
+				err.send(errors.e2d(e))
+		if b2:
+			out.send(b2)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""end-to-end pipeline benchmarks
+
+Each case runs a pipeline over a synthetic stream of records, in a process of
+its own, and measures the records per second and the peak resident memory
+(ru_maxrss, including any child processes, e.g. of CLI chains).  The results
+are written to stdout as dio dicts, one per case:
+
+	{"case": "sort", "records": 100000, "seconds": 1.2,
+	 "records_per_sec": 83333.3, "maxrss_kb": 51200}
+
+With --compare, each result also gets the baseline's numbers, the ratios of
+change, and whether it's a regression: slower, or bigger, by more than the
+threshold; a case that fails is a regression, too.  The exit status is 1 if
+there are any regressions, or any cases that fail (with or without --compare),
+or that failed in the baseline, so can't be compared.  With --save, the
+results are also written to the given file, to compare with later.
+Baselines are specific to the machine, so they're not kept in git.
+
+Run with dio and its bin directory in the environment (see setup.sh), e.g.:
+
+	make baseline  #before the change
+	make run  #after the change
+"""
+
+
+import sys, os, time, resource, subprocess, tempfile, optparse, json
+
+import dio
+import dio.coreutils
+
+import benchlib
+
+
+DEFAULT_RECORDS = 100000
+DEFAULT_THRESHOLD = 0.2  #fractional change in speed or memory that's a regression
+
+
+#--- the cases
+
+#each is a function of the number of records and the path of a file of that
+#many synthetic records, as JSON, which runs the pipeline; the time spent
+#making its input is not counted, as long as that's done lazily
+
+def json_filter(n, path):
+	sink = dio.json_out(out=open(os.devnull, 'w'))
+	dio.json_in(inn=open(path),
+		out=dio.filter(lambda d: d['x'] > 500,
+			out=sink
+		)
+	)
+	sink.close()  #(so its last write is timed, too)
+
+def json_filter_raw(n, path):
+	sink = dio.json_out(out=open(os.devnull, 'w'))
+	dio.json_in(inn=open(path), raw=True,
+		out=dio.filter(lambda d: d['x'] > 500,
+			out=sink
+		)
+	)
+	sink.close()
+
+def tidy_extensions(n, path):
+	dio.source(benchlib.lazy_records(n),
+		out=dio.tidy(('id', 'sum', 'label', 'sum_sq'),
+			out=benchlib.null()
+		)
+	)
+
+def count(n, path):
+	dio.source(benchlib.numbers(n), out=dio.count(out=benchlib.null()))
+
+def sum_(n, path):
+	dio.source(benchlib.numbers(n), out=dio.sum_(out=benchlib.null()))
+
+def average(n, path):
+	dio.source(benchlib.numbers(n), out=dio.average(out=benchlib.null()))
+
+def min_(n, path):
+	dio.source(benchlib.records(n), out=dio.min_(10, 'y', out=benchlib.null()))
+
+def max_(n, path):
+	dio.source(benchlib.records(n), out=dio.max_(10, 'y', out=benchlib.null()))
+
+def sort(n, path):
+	dio.source(benchlib.records(n), out=dio.coreutils.sort(('x', 'id'), out=benchlib.null()))
+
+def sort_spill(n, path):
+	dio.source(benchlib.lazy_records(n),
+		out=dio.coreutils.sort(('sum',), buffer_size=max(n/10, 1), out=benchlib.null())
+	)
+
+def cli_chain(n, path):
+	subprocess.check_call(
+		'dio.filter %%x -gt 500 < %s | dio.tidy id x y | dio.sort y | dio.wc > %s' % (path, os.devnull),
+		shell=True,
+	)
+
+CASES = [
+	json_filter,
+	json_filter_raw,
+	tidy_extensions,
+	count,
+	sum_,
+	average,
+	min_,
+	max_,
+	sort,
+	sort_spill,
+	cli_chain,
+]
+
+
+#--- running
+
+def run_case(name, n, path):
+	"""Run the named case in this process, and return its result dict."""
+	f = dict([ (c.__name__, c) for c in CASES ])[name]
+
+	t = time.time()
+	f(n, path)
+	seconds = time.time() - t
+
+	maxrss = max(
+		resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+	)
+
+	return {
+		'case': name,
+		'records': n,
+		'seconds': seconds,
+		'records_per_sec': n / seconds if seconds > 0 else None,
+		'maxrss_kb': maxrss,  #(kilobytes on Linux)
+	}
+
+def run(name, n, path):
+	"""Run the named case in a new process, and return its result dict."""
+	p = subprocess.Popen(
+		[sys.executable, os.path.abspath(__file__), '--child', name, '--records', str(n), path],
+		stdout=subprocess.PIPE,
+	)
+	stdout = p.communicate()[0]
+	if p.returncode != 0:
+		return {'case': name, 'records': n, 'error': 'exited with status %d' % p.returncode}
+	return json.loads(stdout)
+
+def compare(result, baseline, threshold):
+	"""Add the comparison with the baseline result to result."""
+	result['regression'] = 'error' in result
+	if baseline is None or 'error' in result:
+		return
+	if 'error' in baseline:
+		result['baseline_error'] = baseline['error']
+		return
+	for k, worse in (('records_per_sec', lambda change: change < 1 - threshold), ('maxrss_kb', lambda change: change > 1 + threshold)):
+		if result.get(k) and baseline.get(k):
+			change = float(result[k]) / baseline[k]
+			result['baseline_' + k] = baseline[k]
+			result['change_' + k] = change
+			if worse(change):
+				result['regression'] = True
+
+def load(path):
+	"""Return the results in the file at path, by case."""
+	results = []
+	dio.json_in(inn=open(path), out=dio.buffer_out(out=results))
+	return dict([ (d['case'], d) for d in results ])
+
+
+#--- main
+
+def main():
+	parser = optparse.OptionParser(usage='%prog [options] [CASE...]')
+	parser.add_option('--records', type='int', default=DEFAULT_RECORDS,
+		help='the number of records per case (default: %default)')
+	parser.add_option('--compare', metavar='FILE',
+		help='compare with the baseline results in FILE, if it exists')
+	parser.add_option('--save', metavar='FILE',
+		help='also write the results to FILE')
+	parser.add_option('--threshold', type='float', default=DEFAULT_THRESHOLD,
+		help='the fractional change in speed or memory that is a regression (default: %default)')
+	parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+	options, args = parser.parse_args()
+
+	if options.child:
+		name, path = args
+		sys.stdout.write(json.dumps(run_case(name, options.records, path)) + '\n')
+		return 0
+
+	names = [ c.__name__ for c in CASES ]
+	for name in args:
+		if name not in names:
+			parser.error('unknown case %r (the cases are: %s)' % (name, ', '.join(names)))
+	if args:
+		names = args
+
+	baselines = {}
+	if options.compare and os.path.exists(options.compare):
+		baselines = load(options.compare)
+
+	fd, path = tempfile.mkstemp(suffix='.json')
+	os.close(fd)
+	try:
+		benchlib.write_json(path, options.records)
+
+		results = []
+		for name in names:
+			result = run(name, options.records, path)
+			if options.compare:
+				compare(result, baselines.get(name), options.threshold)
+			dio.default_out.send(result)
+			results.append(result)
+	finally:
+		os.unlink(path)
+
+	if options.save:
+		f = open(options.save, 'w')
+		try:
+			dio.source(results, out=dio.json_out(out=f))
+		finally:
+			f.close()
+
+	if [ r for r in results if r.get('regression') or 'error' in r or 'baseline_error' in r ]:
+		return 1
+	return 0
+
+if __name__=='__main__':
+	sys.exit(main())
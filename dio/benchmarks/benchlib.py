@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""synthetic data for the benchmarks
+
+The records are deterministic, so runs are comparable.
+"""
+
+
+import dio
+from dio import lazydict, processor
+
+
+#--- plain records
+
+def records(n):
+	"""Yield n synthetic plain dicts."""
+	for i in xrange(n):
+		yield {
+			'id': i,
+			'name': 'name%d' % (i % 1000),
+			'x': (i * 7919) % 1000,
+			'y': ((i * 104729) % 10000) / 100.0,
+			'tags': ['a', 'b', 'c'][:i % 4],
+		}
+
+def numbers(n):
+	"""Yield n synthetic dicts of just numbers, e.g. for the reducers."""
+	for d in records(n):
+		yield {'x': d['x'], 'y': d['y']}
+
+def write_json(path, n):
+	"""Write n synthetic records to the file at path, as JSON."""
+	f = open(path, 'w')
+	try:
+		dio.source(records(n), out=dio.json_out(out=f))
+	finally:
+		f.close()
+
+
+#--- a LazyDict
+
+class x_sum(lazydict.Extension):
+	source = ('x', 'y')
+	target = ('sum', 'diff')
+	def __call__(self, x, y):
+		return x+y, x-y
+
+class x_label(lazydict.Extension):
+	source = ('name',)
+	target = ('label',)
+	def __call__(self, name):
+		return name.upper(),
+
+class x_sum_sq(lazydict.Extension):
+	source = ('sum',)
+	target = ('sum_sq',)
+	def __call__(self, sum):
+		return sum*sum,
+
+class Record(lazydict.LazyDict):
+	_keys = [
+		'id',
+		'name',
+		'x',
+		'y',
+		'tags',
+
+		'sum',
+		#x+y
+
+		'diff',
+		#x-y
+
+		'label',
+		#name, in upper case
+
+		'sum_sq',
+		#sum squared
+	]
+
+	extensions = [
+		x_sum(),
+		x_label(),
+		x_sum_sq(),
+	]
+
+def lazy_records(n):
+	"""Yield n synthetic Records."""
+	for d in records(n):
+		yield Record(d)
+
+
+#--- a sink
+
+@processor
+def null(out=None, err=None):
+	"""Discard all input."""
+	while True:
+		yield
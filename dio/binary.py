@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""a binary stream format of compressed blocks of dicts
+
+This is for intermediate files, where JSON's text is just overhead.  Dicts are
+written in blocks, each of which can be compressed and decoded independently,
+so reading can be spread over several processes, and an index at the end
+allows reading just some of the blocks (e.g. to split a file between jobs).
+
+The format is:
+
+	stream := MAGIC block* [index footer]
+
+	MAGIC := 'DIOB\\x01'
+
+	block := codec length payload
+		codec is one byte: 'n' (none), 'z' (zlib), 'b' (bz2), or 'x' (lzma);
+		length is the byte length of the payload, as a 4-byte big-endian
+		unsigned int; the payload, once decompressed, is a pickle (protocol 2)
+		of the list of the block's dicts in their pre_serialize() form
+
+	index := 'i' length payload
+		the payload is, for each block, its offset from the start of the
+		stream and number of dicts, as 8-byte and 4-byte big-endian unsigned
+		ints
+
+	footer := offset 'DIOI'
+		offset is that of the index, as an 8-byte big-endian unsigned int
+
+The index is written when the sink is closed, so a truncated stream is still
+readable, just without the index.  LZMA needs an lzma module (Python 2 does not
+have one in the standard library, but backports.lzma works).
+"""
+
+
+import struct, itertools, zlib, bz2, cPickle, multiprocessing
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+from dio import processor, suppress_epipe, pre_serialize, post_deserialize, _Window
+
+
+MAGIC = 'DIOB\x01'
+INDEX_MAGIC = 'DIOI'
+
+DEFAULT_BLOCK_SIZE = 1000  #number of dicts per block
+
+_block_header = struct.Struct('>cI')  #codec, length
+_index_entry = struct.Struct('>QI')  #offset, count
+_footer = struct.Struct('>Q4s')  #offset, INDEX_MAGIC
+
+#compression by name, as (codec, compress), and decompression by codec
+_compressors = {
+	None: ('n', lambda s: s),
+	'zlib': ('z', zlib.compress),
+	'bz2': ('b', bz2.compress),
+}
+_decompressors = {
+	'n': lambda s: s,
+	'z': zlib.decompress,
+	'b': bz2.decompress,
+}
+if lzma is not None:
+	_compressors['lzma'] = ('x', lzma.compress)
+	_decompressors['x'] = lzma.decompress
+
+
+#--- reading
+
+class FormatError(Exception):
+	"""The stream is not in the dio binary format."""
+
+def _read_exactly(f, n):
+	s = f.read(n)
+	if len(s) != n:
+		raise FormatError('truncated stream (expected %d bytes, got %d)' % (n, len(s)))
+	return s
+
+def _read_blocks(f):
+	"""Yield (codec, payload) for each block from f, up to the index or EOF."""
+	while True:
+		header = f.read(_block_header.size)
+		if not header:
+			break
+		if len(header) != _block_header.size:
+			raise FormatError('truncated block header')
+		codec, length = _block_header.unpack(header)
+		if codec == 'i':
+			break
+		yield codec, _read_exactly(f, length)
+
+def _decode_block(block):
+	"""Return the list of dicts in block, a (codec, payload) tuple.
+
+	The dicts are still in their serialized form.  This runs in the worker
+	processes.
+	"""
+	codec, payload = block
+	try:
+		decompress = _decompressors[codec]
+	except KeyError:
+		raise FormatError('unknown block codec %r' % codec)
+	return cPickle.loads(decompress(payload))
+
+def read_index(f):
+	"""Return the index of the stream in seekable file f.
+
+	:returns: a list of (offset, count) for each block, or None if the stream
+		has no index
+
+	This leaves the position of f undefined.
+	"""
+	f.seek(0, 2)
+	if f.tell() < len(MAGIC) + _footer.size:
+		return None
+	f.seek(-_footer.size, 2)
+	offset, magic = _footer.unpack(f.read(_footer.size))
+	if magic != INDEX_MAGIC:
+		return None
+	f.seek(offset)
+	codec, length = _block_header.unpack(_read_exactly(f, _block_header.size))
+	payload = _read_exactly(f, length)
+	return [ _index_entry.unpack_from(payload, i) for i in xrange(0, length, _index_entry.size) ]
+
+@processor
+def binary_in(inn=None, workers=None, start=None, stop=None, out=None, err=None):
+	"""Read dicts in the dio binary format from file-like inn.
+
+	:param workers: the number of processes with which to decode blocks, or 0
+		to decode them in this process (default: the number of CPUs)
+	:param start, stop: if either is given, read only those blocks, as in
+		blocks[start:stop]; this requires a seekable file with an index
+
+	Dicts are output in order regardless.  At most twice as many blocks as
+	workers are read but not yet output at a time.
+	"""
+	if start is not None or stop is not None:
+		index = read_index(inn)
+		if index is None:
+			raise FormatError('reading a range of blocks requires an index')
+		index = index[start:stop]
+		if not index:
+			return
+		inn.seek(index[0][0])
+		blocks = itertools.islice(_read_blocks(inn), len(index))
+	else:
+		if _read_exactly(inn, len(MAGIC)) != MAGIC:
+			raise FormatError('not a dio binary stream')
+		blocks = _read_blocks(inn)
+
+	if workers is None:
+		workers = multiprocessing.cpu_count()
+	if workers > 0:
+		pool = multiprocessing.Pool(workers)
+		window = _Window(blocks, 2*workers)
+		chunks = pool.imap(_decode_block, window)
+	else:
+		pool = None
+		window = None
+		chunks = ( _decode_block(b) for b in blocks )
+
+	try:
+		for chunk in chunks:
+			if window is not None:
+				window.release()
+			for d in chunk:
+				out.send(post_deserialize(d))
+	finally:
+		if window is not None:
+			window.stop()
+		if pool is not None:
+			pool.terminate()
+
+
+#--- writing
+
+@processor
+@suppress_epipe
+def binary_out(out=None, err=None, block_size=DEFAULT_BLOCK_SIZE, compression='zlib'):
+	"""Write dicts in the dio binary format to file-like out.
+
+	:param block_size: the number of dicts per block
+	:param compression: 'zlib', 'bz2', 'lzma', or None
+	"""
+	try:
+		codec, compress = _compressors[compression]
+	except KeyError:
+		raise ValueError('unsupported compression %r' % compression)
+
+	state = {'offset': 0}
+	index = []
+
+	def write(codec, payload):
+		out.write(_block_header.pack(codec, len(payload)))
+		out.write(payload)
+		state['offset'] += _block_header.size + len(payload)
+
+	def write_block(ds):
+		index.append(_index_entry.pack(state['offset'], len(ds)))
+		write(codec, compress(cPickle.dumps(ds, cPickle.HIGHEST_PROTOCOL)))
+
+	out.write(MAGIC)
+	state['offset'] += len(MAGIC)
+
+	ds = []
+	try:
+		while True:
+			d = yield
+			ds.append(d if type(d) is dict else dict(pre_serialize(d)))
+			if len(ds) >= block_size:
+				write_block(ds)
+				ds = []
+	except GeneratorExit:
+		if ds:
+			write_block(ds)
+		offset = state['offset']
+		write('i', ''.join(index))
+		out.write(_footer.pack(offset, INDEX_MAGIC))
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""JSON encoding and decoding for the dio json sources and sinks
+
+One encoder and one decoder are created up front and reused for every record,
+rather than going through json.dump()/json.loads(), which do argument handling
+(and, for dump, many small writes) on every call.
+
+If simplejson is importable, it's used instead of the standard library's json,
+since its C speedups are faster and its output is the same.  (Backends such
+as ujson format their output differently, so they are not used.)  To force
+the standard library, set the environment variable DIO_JSON=json.
+
+decode_interned() is decode() with the keys of each decoded dict shared with
+those of every other, so records that are kept around (e.g. by a sort) don't
+each have their own copies of the same key strings.  It's slower, since each
+dict is built in Python.
+"""
+
+
+import os
+
+json = None
+if os.environ.get('DIO_JSON', 'simplejson') == 'simplejson':
+	try:
+		import simplejson as json
+	except ImportError:
+		pass
+if json is None:
+	import json
+
+BACKEND = json.__name__  #the name of the module in use
+
+_encoder = json.JSONEncoder()
+_decoder = json.JSONDecoder()
+
+encode = _encoder.encode  #return the JSON string for the given dict
+decode = _decoder.decode  #return the dict for the given JSON string
+
+
+#--- interned keys
+
+MAX_INTERNED_KEYS = 10000  #beyond this many, keys are no longer interned (in
+                           #case they're data rather than a schema)
+
+_interned = {}
+
+def _intern_pairs(pairs):
+	d = {}
+	for k, v in pairs:
+		try:
+			k = _interned[k]
+		except KeyError:
+			if len(_interned) < MAX_INTERNED_KEYS:
+				_interned[k] = k
+		d[k] = v
+	return d
+
+decode_interned = json.JSONDecoder(object_pairs_hook=_intern_pairs).decode
+
+
+#--- raw records
+
+class RawRecord(object):
+	"""A dict that's decoded from its JSON line only when it's first used.
+
+	This keeps the line, and as long as the record is not modified, json_out
+	writes it back out as is, so stages that just pass records along (or only
+	look at a few of them) skip the decoding and encoding.  Since values that
+	are lists or dicts can be modified in place, getting one counts as
+	modifying the record.  A line that is not valid JSON is only noticed if the
+	record is used.
+
+	This has the mapping interface of a dict, but is not one.  (Where a real
+	dict is needed, use dict(d), or pre_serialize.)
+	"""
+
+	__slots__ = ('_line', '_d')
+
+	def __init__(self, line):
+		self._line = line  #the original line, or None if modified
+		self._d = None  #the decoded dict, or None if not decoded yet
+
+	def line(self):
+		"""Return the original line, or None if the record has been modified."""
+		return self._line
+
+	def dict(self):
+		"""Return the decoded dict (which is the record's own, not a copy)."""
+		d = self._d
+		if d is None:
+			d = self._d = decode(self._line)
+		return d
+
+	def _modified(self):
+		"""Return the decoded dict, for modifying."""
+		d = self.dict()
+		self._line = None
+		return d
+
+	def _value(self, v):
+		if isinstance(v, (list, dict)):
+			self._line = None
+		return v
+
+	def _values(self, vs):
+		for v in vs:
+			if isinstance(v, (list, dict)):
+				self._line = None
+				break
+		return vs
+
+
+	#--- reading
+
+	def __getitem__(self, key):
+		return self._value(self.dict()[key])
+
+	def get(self, key, default=None):
+		return self._value(self.dict().get(key, default))
+
+	def __contains__(self, key):
+		return key in self.dict()
+
+	def has_key(self, key):
+		return key in self.dict()
+
+	def __iter__(self):
+		return iter(self.dict())
+
+	def __len__(self):
+		return len(self.dict())
+
+	def iterkeys(self):
+		return self.dict().iterkeys()
+
+	def keys(self):
+		return self.dict().keys()
+
+	def values(self):
+		return self._values(self.dict().values())
+
+	def itervalues(self):
+		return iter(self.values())
+
+	def items(self):
+		items = self.dict().items()
+		self._values([ v for k, v in items ])
+		return items
+
+	def iteritems(self):
+		return iter(self.items())
+
+	def copy(self):
+		if self._line is not None:
+			return RawRecord(self._line)
+		return RawRecord(encode(self._d))
+
+
+	#--- modifying
+
+	def __setitem__(self, key, value):
+		self._modified()[key] = value
+
+	def __delitem__(self, key):
+		del self._modified()[key]
+
+	def pop(self, key, *default):
+		return self._modified().pop(key, *default)
+
+	def popitem(self):
+		return self._modified().popitem()
+
+	def setdefault(self, key, default=None):
+		return self._modified().setdefault(key, default)
+
+	def update(self, *args, **kwargs):
+		self._modified().update(*args, **kwargs)
+
+	def clear(self):
+		self._modified().clear()
+
+
+	#--- comparison and representation
+
+	def __eq__(self, other):
+		if isinstance(other, RawRecord):
+			if self._line is not None and self._line == other._line:
+				return True
+			other = other.dict()
+		elif not isinstance(other, dict):
+			return NotImplemented
+		return self.dict() == other
+
+	def __ne__(self, other):
+		eq = self.__eq__(other)
+		if eq is NotImplemented:
+			return eq
+		return not eq
+
+	__hash__ = None
+
+	def __repr__(self):
+		return repr(self.dict())
+
+	def __reduce__(self):
+		return (RawRecord, (self._line if self._line is not None else encode(self._d),))
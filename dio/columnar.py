@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""columnar storage of dicts, with numpy
+
+For numeric data, storing each key's values as a typed array is far smaller
+than rows of dicts, and reading it back is a memory map rather than parsing.
+
+A columnar dataset is a directory.  Dicts are grouped into chunks of a fixed
+number of rows, and each chunk has one .npy file per key:
+
+	index.json
+	000000.0.npy
+	000000.1.npy
+	000000.1.mask.npy
+	000001.0.npy
+	...
+
+where index.json is:
+
+	{
+		"columns": ["x", "y"],
+		"chunks": [
+			{"name": "000000", "rows": 65536, "masked": ["y"]},
+			...
+		]
+	}
+
+and the files for chunk c are c.i.npy, the values of columns[i] for each row,
+and, for the columns listed as masked (those that some rows lack), c.i.mask.npy,
+a boolean array of whether each row has a value.  Missing values are filled in
+with some value present in the chunk.  Columns whose values are not all
+numbers, or all strings, of the same type (e.g. mixed types, None, lists) are
+stored as pickled object arrays, which can't be memory-mapped.  LazyDicts are
+stored with their class in the __class__ column, as usual for serialization,
+and only with the values they have (nothing is extended in writing them).
+"""
+
+
+import os, json
+
+from dio import processor, pre_serialize, post_deserialize
+
+
+DEFAULT_CHUNK_SIZE = 65536  #number of rows per chunk
+
+INDEX = 'index.json'
+
+
+#--- writing
+
+#value types that are stored as typed arrays when all of a column's values are
+#of the same one (numpy would otherwise coerce mixed values, e.g. 1 and 'a' to
+#strings)
+_scalar_types = (bool, int, long, float, str, unicode)
+
+def _array(values):
+	"""Return the numpy array for the list of values."""
+	import numpy as np
+	types = set(type(v) for v in values)
+	if len(types) == 1 and types.pop() in _scalar_types:
+		return np.array(values)
+	a = np.empty(len(values), dtype=object)
+	for i, v in enumerate(values):
+		a[i] = v
+	return a
+
+def _write_chunk(path, name, columns, ds):
+	"""Write the dicts ds as chunk name, and return its index entry.
+
+	:param columns: the list of column names, which this extends as needed
+	"""
+	import numpy as np
+
+	keys = set()
+	for d in ds:
+		keys.update(d.iterkeys())
+	for k in sorted(keys - set(columns)):
+		columns.append(k)
+
+	masked = []
+	for i, k in enumerate(columns):
+		if k not in keys:
+			continue
+
+		present = [ k in d for d in ds ]
+		if all(present):
+			values = [ d[k] for d in ds ]
+		else:
+			masked.append(k)
+			fill = ds[present.index(True)][k]
+			values = [ d.get(k, fill) for d in ds ]
+			np.save(os.path.join(path, '%s.%d.mask.npy' % (name, i)), np.array(present, dtype=bool))
+
+		np.save(os.path.join(path, '%s.%d.npy' % (name, i)), _array(values))
+
+	return {'name': name, 'rows': len(ds), 'masked': masked}
+
+@processor
+def columnar_out(path, chunk_size=DEFAULT_CHUNK_SIZE, out=None, err=None):
+	"""Write dicts as a columnar dataset in directory path (see above).
+
+	:param chunk_size: the number of rows per chunk
+
+	The directory is created if necessary.  The index is rewritten after each
+	chunk, so the dataset is readable as of the last complete chunk.
+	"""
+	import numpy as np  #(here, so a missing numpy shows up right away)
+
+	if not os.path.isdir(path):
+		os.makedirs(path)
+
+	index = {'columns': [], 'chunks': []}
+
+	def write(ds):
+		name = '%06d' % len(index['chunks'])
+		index['chunks'].append(_write_chunk(path, name, index['columns'], ds))
+		f = open(os.path.join(path, INDEX), 'w')
+		try:
+			json.dump(index, f)
+		finally:
+			f.close()
+
+	ds = []
+	try:
+		while True:
+			d = yield
+			#(as plain dicts, so that checking for keys doesn't extend LazyDicts)
+			ds.append(d if type(d) is dict else dict(pre_serialize(d)))
+			if len(ds) >= chunk_size:
+				write(ds)
+				ds = []
+	except GeneratorExit:
+		if ds or not index['chunks']:
+			write(ds)
+
+
+#--- reading
+
+def _load(filename):
+	"""Load a .npy file, memory-mapped if possible."""
+	import numpy as np
+	try:
+		return np.load(filename, mmap_mode='r')
+	except ValueError:
+		#object arrays can't be memory-mapped
+		return np.load(filename, allow_pickle=True)
+
+@processor
+def columnar_in(path, keys=None, columns=False, out=None, err=None):
+	"""Read a columnar dataset from directory path (see above).
+
+	:param keys: the keys to read (default: all of them)
+	:param columns: whether to output each chunk as one dict of columns,
+		rather than one dict per row
+
+	The columns are numpy arrays, memory-mapped if possible, and for keys that
+	some rows lack, numpy masked arrays.  Dicts output per row have plain
+	Python values, and LazyDicts are restored as usual.
+	"""
+	import numpy as np
+
+	f = open(os.path.join(path, INDEX))
+	try:
+		index = json.load(f)
+	finally:
+		f.close()
+
+	wanted = [ (i, k) for i, k in enumerate(index['columns']) if keys is None or k in keys or k == '__class__' ]
+
+	for chunk in index['chunks']:
+		name = chunk['name']
+		masked = set(chunk['masked'])
+
+		cols = {}
+		for i, k in wanted:
+			filename = os.path.join(path, '%s.%d.npy' % (name, i))
+			if not os.path.exists(filename):
+				continue  #no rows in this chunk have this key
+			values = _load(filename)
+			if k in masked:
+				mask = _load(os.path.join(path, '%s.%d.mask.npy' % (name, i)))
+				values = np.ma.masked_array(values, mask=~mask)
+			cols[k] = values
+
+		if columns:
+			out.send(cols)
+			continue
+
+		#convert to plain Python values, column by column
+		rows = [ {} for r in xrange(chunk['rows']) ]
+		for k, values in cols.iteritems():
+			if isinstance(values, np.ma.MaskedArray):
+				for d, v, m in zip(rows, values.data.tolist(), values.mask.tolist()):
+					if not m:
+						d[k] = v
+			else:
+				for d, v in zip(rows, values.tolist()):
+					d[k] = v
+		for d in rows:
+			out.send(post_deserialize(d))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""conditions on dicts, written as test(1)-like tokens, as for dio.filter
+
+The tokens are translated to a Python expression, one at a time:
+
+	%key        the value of key in the dict, d['key']
+	-lt -le -ge -gt -eq = -ne  (and < <= == >= > !=)  comparisons
+	-a -o !     and, or, not
+	( )         grouping
+	=~ !~       whether or not the value on the left matches the regular
+	            expression on the right (searching, as re.search() does;
+	            values that are not strings are matched as text)
+	-in -notin  whether or not the value on the left is one of the
+	            comma-separated values on the right, e.g. -in 1,2,3
+	numbers, quoted strings, True, and False are Python literals, and
+	anything else is a string (including negative numbers, e.g. -3 is '-3',
+	since a leading - is for operators)
+
+for example:
+
+	%size -gt 1000 -a \\( %name =~ '^tmp' -o %owner -in root,nobody \\)
+
+The expression is compiled once, into a Python function, rather than being
+evaluated anew for each dict.  Regular expressions and sets are built once,
+too.
+
+NOTE: this calls eval() on user-provided input!
+"""
+
+
+import re, ast
+
+
+def quote(s):
+	"""Return the text quoted as a Python string."""
+
+	s = "'" + s.replace("'", """'"'"'""") + "'"
+
+	#get rid of gratuitous leading and trailing empty strings
+	if s.startswith("''"): s = s[2:]
+	if   s.endswith("''"): s = s[:-2]
+
+	return s
+
+#mapping of shell test syntax to Python
+opmap = {
+	#python syntax
+	  '<': '<',
+	 '<=': '<=',
+	 '==': '==',
+	 '>=': '>=',
+	  '>': '>',
+	 '!=': '!=',
+
+	#test(1) syntax
+	'-lt': '<',
+	'-le': '<=',
+	'-ge': '>=',
+	'-gt': '>',
+
+	'-eq': '==',
+	  '=': '==',
+	'-ne': '!=',
+	 '!=': '!=',  #(repeat from above)
+
+	'-o': 'or',
+	'-a': 'and',
+	 '!': 'not',
+}
+
+#operators whose right-hand token is compiled into an object (see below), and
+#the Python operator to use with it
+objmap = {
+	'=~': 'in',
+	'!~': 'not in',
+	'-in': 'in',
+	'-notin': 'not in',
+}
+
+
+class Pattern(object):
+	"""A regular expression that a value is `in' if it matches."""
+
+	__slots__ = ('search',)
+
+	def __init__(self, pattern):
+		self.search = re.compile(pattern).search
+
+	def __contains__(self, value):
+		if not isinstance(value, basestring):
+			value = unicode(value)
+		return self.search(value) is not None
+
+def is_literal(tok):
+	"""Return whether token tok is a Python literal, rather than a string."""
+	return \
+		tok[0].isdigit() or \
+		tok[0] in ('"', "'") or \
+		tok in ('True', 'False')
+
+def literal(s):
+	"""Return the Python value of token s, as process_tok would take it."""
+	if s and is_literal(s):
+		try:
+			return ast.literal_eval(s)
+		except (ValueError, SyntaxError):
+			pass
+	return s
+
+def process_tok(tok):
+	if tok.startswith('%'):
+		return 'd[' + quote(tok[1:]) + ']'
+	if tok in ('(', ')') or is_literal(tok):
+		return tok
+	else:
+		try:
+			return opmap[tok]
+		except KeyError:
+			return quote(tok)
+
+def translate(tokens):
+	"""Return the Python expression for tokens, and its namespace.
+
+	The namespace holds the objects (patterns and sets) it refers to.
+	"""
+	toks = []
+	namespace = {}
+	tokens = iter(tokens)
+	for tok in tokens:
+		if tok in objmap:
+			try:
+				arg = tokens.next()
+			except StopIteration:
+				raise SyntaxError('%s needs a value after it' % tok)
+			name = '_%d' % len(namespace)
+			if tok in ('=~', '!~'):
+				namespace[name] = Pattern(arg)
+			else:
+				namespace[name] = frozenset([ literal(s) for s in arg.split(',') ])
+			toks.append(objmap[tok])
+			toks.append(name)
+		else:
+			toks.append(process_tok(tok))
+	return ' '.join(toks), namespace
+
+def compile_tokens(tokens):
+	"""Return the function of a dict d that evaluates the condition tokens.
+
+	The function also has the attributes:
+
+		select  the function of a list of dicts that returns those for which
+		        the condition is True (with no per-dict function call; see
+		        dio.batch.filter)
+		source  the Python expression
+
+	Raises SyntaxError if the tokens are not a valid condition.
+	"""
+	expression, namespace = translate(tokens)
+	if not expression:
+		raise SyntaxError('empty condition')
+	f = eval('lambda d: (%s)' % expression, namespace)
+	f.select = eval('lambda b: [ d for d in b if (%s) ]' % expression, namespace)
+	f.source = expression
+	return f
@@ -6,39 +6,76 @@
 """processors analogous to GNU coreutils"""
 
 
-from dio import processor
+import heapq, tempfile, cPickle
 
+from dio import processor, sortkey, pre_serialize, post_deserialize
+
+
+#--- sort
+
+DEFAULT_SORT_BUFFER_SIZE = 100000  #number of dicts sort holds in memory
+
+_RUN_CHUNK_SIZE = 1000  #number of dicts pickled at a time in sort's runs
+
+def _write_run(items, tmpdir=None):
+	"""Write sorted (key, seq, d) items to a temporary file, and return it."""
+	f = tempfile.TemporaryFile(dir=tmpdir)
+	for i in xrange(0, len(items), _RUN_CHUNK_SIZE):
+		cPickle.dump(
+			[ (k, seq, (d if type(d) is dict else dict(pre_serialize(d)))) for k, seq, d in items[i:i+_RUN_CHUNK_SIZE] ],
+			f,
+			cPickle.HIGHEST_PROTOCOL,
+		)
+	f.seek(0)
+	return f
+
+def _read_run(f):
+	"""Yield the (key, seq, d) items from a file written by _write_run."""
+	while True:
+		try:
+			chunk = cPickle.load(f)
+		except EOFError:
+			break
+		for k, seq, d in chunk:
+			yield k, seq, post_deserialize(d)
 
 @processor
-def sort(keys=[], reverse=False, out=None, err=None):
+def sort(keys=[], reverse=False, buffer_size=DEFAULT_SORT_BUFFER_SIZE, tmpdir=None, out=None, err=None):
 	"""The dio analogue to coreutils' sort.
 
-	Sorts output by value of the given key.  If key is None, assumes all dicts
-	are one-item, and sorts by the value regardless of key.
+	Sorts output by values of the given keys.  See dio.sortkey for the details
+	of keys and reverse, including sorting by different keys in different
+	directions.  The sort is stable.
+
+	At most buffer_size dicts are held in memory.  Beyond that, they are sorted
+	in runs that are written to temporary files (in tmpdir, if given), and the
+	runs are merged when the input is done.
 	"""
-	if len(keys) == 0:
-		key = None
-	elif len(keys) == 1:
-		key = keys[0]
-	else:
-		raise NotImplementedError(
-			"sorting by more than one key is not yet implemented"
-		)
+	keyf = sortkey(keys, reverse)
 
-	if key is not None:
-		keyf = lambda d: d[key]
-	else:
-		keyf = lambda d: d.itervalues().next()
+	items = []  #(key, seq, d) -- seq breaks ties, for stability
+	runs = []  #temporary files of sorted items
 
-	results = []
+	seq = 0
 	try:
-		while True:
-			d = yield
-			results.append(d)
-	except GeneratorExit:
-		results.sort(key=keyf, reverse=reverse)
-		for d in results:
-			out.send(d)
+		try:
+			while True:
+				d = yield
+				items.append((keyf(d), seq, d))
+				seq += 1
+				if len(items) >= buffer_size:
+					items.sort()
+					runs.append(_write_run(items, tmpdir))
+					items = []
+		except GeneratorExit:
+			items.sort()
+			if runs:
+				items = heapq.merge(*([ _read_run(f) for f in runs ] + [ items ]))
+			for k, seq, d in items:
+				out.send(d)
+	finally:
+		for f in runs:
+			f.close()
 
 @processor
 def uniq(out=None, err=None):
@@ -47,8 +84,8 @@ def uniq(out=None, err=None):
 	while True:
 		d = yield
 		if d!=prev:  #(always True the first time, when prev is None)
+			prev = d.copy()  #(downstream stages, e.g. tidy, may modify d in place)
 			out.send(d)
-		prev = d
 
 @processor
 def wc(out=None, err=None):
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+
+"""per-stage pipeline statistics
+
+When enabled, @processor wraps each stage it creates, so that it counts the
+records going in, out, and to err, and the time spent in the stage itself
+(i.e. not counting the time spent in the stages it sends to).  The statistics
+of each stage are reported as a dio dict:
+
+	{
+		"stage": "dio.tidy",  #the processor's module and name
+		"id": 3,  #stages are numbered in order of creation
+		"in": 1000,  #records sent to it
+		"out": 1000,  #records it sent to out
+		"errors": 0,  #records it sent to err
+		"wall": 0.012,  #seconds spent in it
+		"cpu": 0.011,  #CPU seconds spent in it (of the whole process)
+		"max_latency": 0.0001  #the most wall seconds it spent on any one record
+	}
+
+Batches (see dio.batch) count as the number of records in them.  Records
+written by sinks to files are not counted as out.  Sources count the time of
+the whole run, less that of the rest of the pipeline.
+
+To enable, set the environment variable DIO_STATS (e.g. DIO_STATS=1), and the
+statistics are sent to dio.default_err when the program exits, or call
+enable() before building the pipeline, and report() (or emit()) when it's done.
+Stages created while disabled are not instrumented, and cost nothing extra.
+
+A process that runs many pipelines, one after another or on threads of their
+own (e.g. the daemon, see dio.server), calls begin() on the pipeline's thread
+before building each one, and end() when it's done, so that each pipeline's
+statistics are reported on their own, and then forgotten.
+"""
+
+
+import os, time, types, threading
+
+
+enabled = os.environ.get('DIO_STATS', '') not in ('', '0')
+
+_out = None  #where emit() sends statistics by default (None for dio.default_err)
+
+_stats = []  #the statistics of each instrumented stage
+_local = threading.local()  #the stack of timing frames of the running stages,
+                            #and the statistics since begin(), if any
+
+
+def enable(out=None):
+	"""Instrument stages created from now on.
+
+	:param out: the processor to which emit() sends statistics by default
+		(default: dio.default_err)
+	"""
+	global enabled, _out
+	enabled = True
+	_out = out
+
+def disable():
+	"""Stop instrumenting stages created from now on."""
+	global enabled
+	enabled = False
+
+def begin():
+	"""Keep the statistics of the stages created on this thread from now on
+	apart, until end().
+
+	report() and emit() on this thread then see only those.
+	"""
+	_local.stats = []
+
+def end():
+	"""Forget the statistics kept since begin(), and go back to the shared
+	ones."""
+	try:
+		del _local.stats
+	except AttributeError:
+		pass
+
+def _current():
+	"""Return the list of statistics to which this thread adds stages."""
+	try:
+		return _local.stats
+	except AttributeError:
+		return _stats
+
+def report(reset=False):
+	"""Return the statistics of each instrumented stage, as dio dicts.
+
+	:param reset: whether to also forget the stages (e.g. between pipelines)
+	"""
+	stats = _current()
+	ds = [ s.d() for s in stats ]
+	if reset:
+		del stats[:]
+	return ds
+
+def emit(out=None):
+	"""Send the statistics of each instrumented stage to out, and forget them.
+
+	:param out: a processor (default: as given to enable(), or dio.default_err)
+	"""
+	if out is None:
+		out = _out
+	if out is None:
+		import dio
+		out = dio.default_err
+	for d in report(reset=True):
+		out.send(d)
+
+
+#--- the instrumentation
+
+def _count(d):
+	return len(d) if type(d) is list else 1
+
+class Stats(object):
+	"""The counters of one stage."""
+
+	__slots__ = ('stage', 'id', 'count_in', 'count_out', 'errors', 'wall', 'cpu', 'max_latency')
+
+	def __init__(self, stage, id):
+		self.stage = stage
+		self.id = id
+		self.count_in = 0
+		self.count_out = 0
+		self.errors = 0
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.max_latency = 0.0
+
+	def d(self):
+		return {
+			'stage': self.stage,
+			'id': self.id,
+			'in': self.count_in,
+			'out': self.count_out,
+			'errors': self.errors,
+			'wall': self.wall,
+			'cpu': self.cpu,
+			'max_latency': self.max_latency,
+		}
+
+def _timed(stats, record, f, *args, **kwargs):
+	"""Call f, adding the time spent in it (but not in other stages) to stats.
+
+	:param record: whether this is the handling of one record (i.e. counts
+		toward max_latency)
+	"""
+	try:
+		stack = _local.stack
+	except AttributeError:
+		stack = _local.stack = []
+	frame = [0.0, 0.0]  #the wall and CPU time of stages called from this one
+	stack.append(frame)
+	t, c = time.time(), time.clock()
+	try:
+		return f(*args, **kwargs)
+	finally:
+		wall = time.time() - t
+		cpu = time.clock() - c
+		stack.pop()
+		if stack:
+			stack[-1][0] += wall
+			stack[-1][1] += cpu
+		wall -= frame[0]
+		stats.wall += wall
+		stats.cpu += cpu - frame[1]
+		if record and wall > stats.max_latency:
+			stats.max_latency = wall
+
+class Stage(object):
+	"""A stage's coroutine, wrapped to keep its statistics."""
+
+	__slots__ = ('gen', 'stats')
+
+	def __init__(self, gen, stats):
+		self.gen = gen
+		self.stats = stats
+
+	def send(self, d):
+		self.stats.count_in += _count(d)
+		return _timed(self.stats, True, self.gen.send, d)
+
+	def next(self):
+		return _timed(self.stats, False, self.gen.next)
+
+	def close(self):
+		return _timed(self.stats, False, self.gen.close)
+
+	def throw(self, *args):
+		return _timed(self.stats, False, self.gen.throw, *args)
+
+class _Counter(object):
+	"""The out or err of a stage, wrapped to count what's sent to it."""
+
+	__slots__ = ('target', 'stats', 'attr')
+
+	def __init__(self, target, stats, attr):
+		self.target = target
+		self.stats = stats
+		self.attr = attr
+
+	def send(self, d):
+		setattr(self.stats, self.attr, getattr(self.stats, self.attr) + _count(d))
+		return self.target.send(d)
+
+	def close(self):
+		return self.target.close()
+
+def call(f, args, kwargs):
+	"""Call processor function f as @processor does, but instrumented.
+
+	:returns: a Stage if f is a coroutine, else whatever f returns
+	"""
+	current = _current()
+	stats = Stats('%s.%s' % (f.__module__, f.__name__), len(current))
+	current.append(stats)
+
+	for k, attr in (('out', 'count_out'), ('err', 'errors')):
+		v = kwargs.get(k)
+		if hasattr(v, 'send'):  #(not, e.g., the file of a sink)
+			kwargs[k] = _Counter(v, stats, attr)
+
+	f2 = _timed(stats, False, f, *args, **kwargs)
+	if isinstance(f2, types.GeneratorType):
+		f2 = Stage(f2, stats)
+	return f2
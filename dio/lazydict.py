@@ -30,8 +30,12 @@ Youssef and John A. Brunelle.
 """
 
 
-import logging
-from itertools import repeat, izip, chain
+import time, math, logging, threading
+from itertools import izip
+
+
+_log = logging.getLogger('dio.lazydict')
+_extension_log = logging.getLogger('dio.lazydict.extension')  #each extension call
 
 
 #--- laziness settings: how to handle extra available data
@@ -60,6 +64,208 @@ OVERWRITE_PRESERVE = 1  #preserve the existing values (throw away the new ones)
 DEFAULT_OVERWRITE = OVERWRITE_UPDATE
 
 
+#--- resolution plan limits
+
+MAX_PLANS = 1024  #number of resolution plans cached per class before the cache 
+                  #is cleared and starts over
+
+
+#--- per-extension telemetry
+
+TELEMETRY = False  #whether to keep telemetry (see Extension.telemetry); off by 
+                  #default, since it costs a clock read and a lock per call
+
+#how an extension came to be called
+PATH_DIRECT = 'direct'  #all its sources were present when the key was looked up
+PATH_RECURSIVE = 'recursive'  #as part of a chain that extended its sources first
+PATH_BATCH = 'batch'  #for many records at once, by prefetch()
+
+HISTOGRAM_MIN_EXPONENT = -20  #latencies are counted in power-of-two buckets of 
+                              #seconds, the smallest of which is 2**this (about 
+                              #a microsecond) and below
+
+class Telemetry(object):
+	"""The counts and latency histogram of calls of an extension.
+
+	These are kept per extension, key looked up, and path (see PATH_*).
+	"""
+
+	__slots__ = ('calls', 'records', 'time', 'max', 'histogram')
+
+	def __init__(self):
+		self.calls = 0  #number of calls
+		self.records = 0  #number of records extended (more than calls if batched)
+		self.time = 0.0  #total seconds
+		self.max = 0.0  #the most seconds of any call
+		self.histogram = {}  #number of calls by exponent e, for 2**(e-1) <= seconds < 2**e
+
+	def add(self, records, seconds):
+		self.calls += 1
+		self.records += records
+		self.time += seconds
+		if seconds > self.max:
+			self.max = seconds
+		if seconds > 0:
+			e = max(math.frexp(seconds)[1], HISTOGRAM_MIN_EXPONENT)
+		else:
+			e = HISTOGRAM_MIN_EXPONENT  #(frexp would put 0 with 0.5 to 1)
+		self.histogram[e] = self.histogram.get(e, 0) + 1
+
+	def d(self):
+		"""Return these as a dio dict.
+
+		The histogram is a list of [upper bound in seconds, count], for each 
+		non-empty bucket.
+		"""
+		return {
+			'calls': self.calls,
+			'records': self.records,
+			'time': self.time,
+			'max': self.max,
+			'histogram': [ [2.0**e, n] for e, n in sorted(self.histogram.iteritems()) ],
+		}
+
+_telemetered = []  #the extensions that have telemetry
+
+_telemetry_lock = threading.Lock()  #for all of it, since extensions may be 
+                                    #called from many threads at once (e.g. by 
+                                    #dio.concurrent_extend)
+
+def telemetry():
+	"""Return the telemetry of all extensions, as dio dicts, costliest first.
+
+	See Extension.telemetry().
+	"""
+	_telemetry_lock.acquire()
+	try:
+		extensions = list(_telemetered)
+	finally:
+		_telemetry_lock.release()
+	ds = []
+	for e in extensions:
+		ds.extend(e.telemetry())
+	ds.sort(key=lambda d: d['time'], reverse=True)
+	return ds
+
+def telemetry_clear():
+	"""Drop the telemetry of all extensions."""
+	_telemetry_lock.acquire()
+	try:
+		extensions = list(_telemetered)
+	finally:
+		_telemetry_lock.release()
+	for e in extensions:
+		e.telemetry_clear()
+
+
+#--- shared caching of extension results
+
+class ResultCache(object):
+	"""A size-bounded cache of extension results, shared across records.
+
+	Results are keyed by the tuple of source values.  When full, the least 
+	recently used result is evicted, and if ttl is not None, results older 
+	than ttl seconds are treated as missing.  This is thread-safe.
+	"""
+
+	def __init__(self, size, ttl=None):
+		self.size = size
+		self.ttl = ttl
+
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+
+		self._lock = threading.Lock()
+
+		#a circular doubly linked list of [prev, next, key, value, expiration], 
+		#in order of use (most recent last), and a dict of its links by key
+		self._root = []
+		self._root[:] = [self._root, self._root, None, None, None]
+		self._links = {}
+
+	def get(self, key, default=None):
+		"""Return the value cached for key, or default if there isn't one.
+
+		Raises TypeError if key is not hashable.
+		"""
+		self._lock.acquire()
+		try:
+			link = self._links.get(key)
+			if link is not None and link[4] is not None and link[4] < time.time():
+				self._unlink(link)
+				self.expirations += 1
+				link = None
+			if link is None:
+				self.misses += 1
+				return default
+			self.hits += 1
+
+			#move it to the most recent end
+			prev, next = link[0], link[1]
+			prev[1], next[0] = next, prev
+			last = self._root[0]
+			last[1] = self._root[0] = link
+			link[0], link[1] = last, self._root
+
+			return link[3]
+		finally:
+			self._lock.release()
+
+	def put(self, key, value):
+		"""Cache value for key.
+
+		Raises TypeError if key is not hashable.
+		"""
+		if self.ttl is not None:
+			expiration = time.time() + self.ttl
+		else:
+			expiration = None
+
+		self._lock.acquire()
+		try:
+			link = self._links.get(key)
+			if link is not None:
+				self._unlink(link)
+			elif len(self._links) >= self.size:
+				self._unlink(self._root[1])
+				self.evictions += 1
+
+			last = self._root[0]
+			link = [last, self._root, key, value, expiration]
+			last[1] = self._root[0] = self._links[key] = link
+		finally:
+			self._lock.release()
+
+	def clear(self):
+		"""Drop all cached values (the statistics are kept)."""
+		self._lock.acquire()
+		try:
+			self._root[:] = [self._root, self._root, None, None, None]
+			self._links.clear()
+		finally:
+			self._lock.release()
+
+	def info(self):
+		"""Return the cache statistics, as a dio dict."""
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+			'expirations': self.expirations,
+			'length': len(self._links),
+			'size': self.size,
+		}
+
+	def _unlink(self, link):
+		prev, next = link[0], link[1]
+		prev[1], next[0] = next, prev
+		del self._links[link[2]]
+
+
+#--- extensions
+
 class Extension(object):
 	"""A computation of target data given source data.
 
@@ -67,11 +273,20 @@ class Extension(object):
 	source set and the target set -- and implement __call__, to compute the 
 	tuple of target values given the source values.  If any target key is 
 	non-computable, return None in place of its value.
+
+	Results are normally memoized per record only.  To share them across all 
+	records (e.g. so the same hostname is only looked up once), set the class 
+	variable cache_size to the number of results to keep, and optionally 
+	cache_ttl to the number of seconds they're good for.  The cached values are 
+	shared, not copied.  See cache_info() for hit/miss statistics.
 	"""
 
 	source = ()  #a tuple of keys
 	target = ()  #a tuple of keys
 
+	cache_size = 0  #number of results to share across records (0 for no sharing)
+	cache_ttl = None  #seconds a shared result is good for (None for forever)
+
 	def __repr__(self):
 		return '<(%s)->(%s)>' % (','.join(self.source), ','.join(self.target))
 
@@ -88,38 +303,188 @@ class Extension(object):
 		"""
 		return args
 
-class LazyDict(dict):
-	"""a dict with transparent, on-demand computation and optimizable memoization
+	def call_batch(self, sources):
+		"""Return the target values for each of many sets of source values.
 
-	See the module documentation for the general overview.
+		:param sources: a list of tuples of source values, one per record
 
-	To implement a LazyDict, simply inherit from this base class and define the 
-	class variable `extensions', a list of Extension instances.  The order 
-	matters -- extensions are attempted roughly in order.  It's also extremely 
-	good practice to document the expected keys and their value types in the 
-	class doc.
+		:rtype: list of tuples, in the same order as sources
 
-	__getattr__ and related methods will raise KeyError if the data is not 
-	present, such as:
+		Override this when computing many results at once is cheaper than one 
+		at a time, e.g. one database query for many keys.  It is used by 
+		prefetch().  The default implementation just calls the extension once 
+		per set of source values.
+		"""
+		return [ self(*args) for args in sources ]
 
-		* the key(s) necessary to compute the values through extensions are not 
-		  present
+	def cache_info(self):
+		"""Return the statistics of the shared result cache, as a dio dict.
 
-		* there is no extension that computes the value for that key
+		Returns None if the extension does not use a shared cache.
+		"""
+		cache = self._cache()
+		if cache is None:
+			return None
+		info = cache.info()
+		info['extension'] = repr(self)
+		return info
 
-		* data extension is limited by the laziness setting
+	def cache_clear(self):
+		"""Drop all shared cached results, if any."""
+		cache = self._cache()
+		if cache is not None:
+			cache.clear()
 
-	There are two `special' keys:
+	def telemetry(self):
+		"""Return the telemetry of this extension, as a list of dio dicts.
 
-		_laziness: the laziness setting (see module doc)
+		There is one for each key whose lookup led to calling the extension 
+		and path by which it did (see PATH_*), with the extension (its repr), 
+		key, and path, along with the fields of Telemetry.d().
+		"""
+		ds = []
+		_telemetry_lock.acquire()
+		try:
+			items = [ (kp, t.d()) for kp, t in self.__dict__.get('_telemetry', {}).iteritems() ]
+		finally:
+			_telemetry_lock.release()
+		for (key, path), d in items:
+			d['extension'] = repr(self)
+			d['key'] = key
+			d['path'] = path
+			ds.append(d)
+		return ds
 
-		_overwrite: the overwrite setting (see module doc)
+	def telemetry_clear(self):
+		"""Drop the telemetry of this extension."""
+		_telemetry_lock.acquire()
+		try:
+			if self.__dict__.pop('_telemetry', None) is not None:
+				_telemetered.remove(self)
+		finally:
+			_telemetry_lock.release()
 
-	Key values are never None -- that special value is used internally during 
-	extension evaluation.  This might change, we'll see what problems we run 
-	into...
+	def _record(self, key, path, records, seconds):
+		"""Add a call to the telemetry."""
+		_telemetry_lock.acquire()
+		try:
+			try:
+				telemetry = self.__dict__['_telemetry']
+			except KeyError:
+				telemetry = self.__dict__['_telemetry'] = {}
+				_telemetered.append(self)
+			try:
+				t = telemetry[key, path]
+			except KeyError:
+				t = telemetry[key, path] = Telemetry()
+			t.add(records, seconds)
+		finally:
+			_telemetry_lock.release()
+
+	def _cache(self):
+		"""Return the ResultCache for this extension, or None if not caching."""
+		try:
+			return self.__dict__['_result_cache']
+		except KeyError:
+			if not self.cache_size:
+				return None
+			return self.__dict__.setdefault('_result_cache', ResultCache(self.cache_size, self.cache_ttl))
+
+	def _evaluate(self, args):
+		"""Return the target values for the tuple of source values args.
+
+		This is how LazyDict calls extensions, through the shared cache, if any.
+		"""
+		if not self.cache_size:
+			return self(*args)
+		cache = self._cache()
+		try:
+			values = cache.get(args)
+		except TypeError:
+			#unhashable source values can't be cached
+			return self(*args)
+		if values is None:
+			values = self(*args)
+			cache.put(args, values)
+		return values
+
+	def _evaluate_batch(self, sources):
+		"""The batch version of _evaluate(), using call_batch()."""
+		if not self.cache_size:
+			return self.call_batch(sources)
+		cache = self._cache()
+
+		results = []
+		misses = []  #indexes into sources and results
+		for i, args in enumerate(sources):
+			try:
+				values = cache.get(args)
+			except TypeError:
+				values = None
+			results.append(values)
+			if values is None:
+				misses.append(i)
+
+		if misses:
+			for i, values in izip(misses, self.call_batch([ sources[i] for i in misses ])):
+				results[i] = values
+				try:
+					cache.put(sources[i], values)
+				except TypeError:
+					pass
+
+		return results
+
+class LazyDictType(type):
+	"""The metaclass of LazyDict, which indexes extensions by target key.
+
+	Looking up a missing key only needs to consider the extensions that target 
+	it, so each LazyDict class keeps a mapping from target key to the tuple of 
+	extensions (in their original order) that compute it.  The index is built 
+	when the class is created and rebuilt whenever `extensions' is reassigned 
+	on it, including for any subclasses that inherit it.  Modifying the 
+	extensions list in place is not tracked; reassign it instead.
+
+	Rebuilding the index also discards the class's cached resolution plans 
+	(see LazyDict._plan).
 	"""
 
+	def __init__(cls, name, bases, dct):
+		super(LazyDictType, cls).__init__(name, bases, dct)
+		cls._index_extensions()
+
+	def __setattr__(cls, name, value):
+		super(LazyDictType, cls).__setattr__(name, value)
+		if name == 'extensions':
+			cls._index_extensions()
+
+	def _index_extensions(cls):
+		index = {}
+		for e in cls.extensions:
+			for k in e.target:
+				index.setdefault(k, []).append(e)
+		for k, v in index.iteritems():
+			index[k] = tuple(v)
+		type.__setattr__(cls, '_extensions_by_target', index)
+		type.__setattr__(cls, '_plans', {})
+
+		#subclasses that inherit extensions need their index updated, too
+		for sub in cls.__subclasses__():
+			if 'extensions' not in sub.__dict__:
+				sub._index_extensions()
+
+class LazyBase(object):
+	"""The extension machinery shared by LazyDict and compact records.
+
+	This does all its reading of the underlying data through the _raw_* 
+	methods, which subclasses implement for their storage, so that extending 
+	never recurses into extending.
+	"""
+
+	__metaclass__ = LazyDictType
+
+	__slots__ = ()
+
 
 	#--- subclasses should set this
 
@@ -131,6 +496,14 @@ class LazyDict(dict):
 	_extension_count = 0  #number of times extensions have been called
 
 
+	#--- raw access, without extending
+
+	#_raw_get(key): return the value for key, or raise KeyError
+	#_raw_contains(key): return whether key is present
+	#_raw_keys(): return an iterator over the present keys
+	#_raw_setting(key, default): return the value for key, or default
+
+
 	def has_key(self, key):
 		"""dict's has_key, with transparent LazyDict semantics.
 
@@ -146,67 +519,563 @@ class LazyDict(dict):
 		except KeyError:
 			return False
 		return True
-	
-	def __getitem__(self, key):
-		"""dict's __getitem__, with transparent LazyDict semantics.
 
-		Note that this is recursive, and there is no guarantee of termination.  
-		If extensions create loops, this may recurse infinitely.
+	def _lookup(self, key):
+		"""Return the value for the missing key, computing it if possible.
 
-		This method itself is rather optimized for LAZINESS_QUERY_OPTIMIZED, as 
-		it usually uses EAFP (try/except) over of LBYL (if/hasattr), which 
-		assumes success will be more frequent than failure.
+		This follows the resolution plan for key given the keys that are 
+		present (see _plan), trying each alternative in turn until one 
+		produces it.  It raises KeyError if none does.
 
 		TODO:
 			* The code assumes no extensions set _laziness and _overwrite.  
 			  That should be supported, as it could be useful.
 		"""
+		if self._raw_setting('_laziness',DEFAULT_LAZINESS) == LAZINESS_LOCKED:
+			#if extending is not allowed, we don't have it, and we're done
+			raise KeyError(key)
+
+		#try to compute it through extensions
+		self._resolve(self._plan(key, frozenset(self._raw_keys())), key, key)
+
+		return self._raw_get(key)  #(may still raise KeyError)
+
+	def _resolve(self, plan, key, trigger, nested=False):
+		"""Follow plan (see _plan) to get the value for key.
+
+		:param trigger: the key whose lookup this is for, for the telemetry
+		:param nested: whether this is for the source of another extension
+
+		:returns: whether or not the value for key was computed
+		:rtype: bool
+		"""
+		for e, sources in plan:
+			for sk, subplan in sources:
+				#skip sources that are already there (e.g. stored as a side 
+				#effect of an earlier step); give up on this alternative if a 
+				#source can't be had
+				if not self._raw_contains(sk) and not self._resolve(subplan, sk, trigger, True):
+					break
+			else:
+				path = PATH_RECURSIVE if nested or sources else PATH_DIRECT
+				if self._extend(e, key, trigger, path):
+					return True
+		return False
+
+	def _extend(self, e, key, trigger=None, path=PATH_DIRECT):
+		"""Run extension e to get the value for key, and store the results.
+
+		:param trigger: the key whose lookup this is for (default: key), for the 
+			telemetry
+		:param path: how the extension came to be called (see PATH_*), for the 
+			telemetry
+
+		:returns: whether or not the value for key was computed
+		:rtype: bool
+		"""
+		args = self._sources(e)
+		if args is None:
+			return False
+
+		if _extension_log.isEnabledFor(logging.DEBUG):
+			_extension_log.debug(repr(e))
+		LazyBase._extension_count += 1
+
+		if TELEMETRY:
+			t = time.time()
+			values = e._evaluate(args)
+			e._record(key if trigger is None else trigger, path, 1, time.time() - t)
+		else:
+			values = e._evaluate(args)
+
+		return self._store(e, key, values)
+
+	def _sources(self, e):
+		"""Return the tuple of source values for extension e, or None.
+
+		None means a source is not there (e.g. an earlier step in the plan that 
+		should have provided it did not).  No extending is done.
+		"""
+		try:
+			return tuple([ self._raw_get(sk) for sk in e.source ])
+		except KeyError:
+			return None
+
+	def _store(self, e, key, values):
+		"""Store the target values computed by extension e to get key.
+
+		Other target values are stored, too, according to the laziness and 
+		overwrite settings.
 
+		:returns: whether or not the value for key was computed
+		:rtype: bool
+		"""
+		fulfilled = False
+		for k, v in izip(e.target, values):
+			if v is not None:
+				if k == key:
+					#this is the key we want -- store the value
+					self[k] = v
+					fulfilled = True
+					if self._raw_setting('_laziness',DEFAULT_LAZINESS) == LAZINESS_DATA_OPTIMIZED:
+						#we have what we need and don't care about the rest of the target data
+						break
+				elif self._raw_setting('_laziness',DEFAULT_LAZINESS) == LAZINESS_QUERY_OPTIMIZED:
+					#this is not the key that we want, but store the value so we don't have to re-query
+					#but only if it's not already there or the instance is configured to update existing data
+					if not self._raw_contains(k) or self._raw_setting('_overwrite',DEFAULT_OVERWRITE) == OVERWRITE_UPDATE:
+						self[k] = v
+		return fulfilled
+
+	@classmethod
+	def _plan(cls, key, present):
+		"""Return the resolution plan for key, given the set of present keys.
+
+		A plan is a tuple of alternatives, to be tried in order, and each 
+		alternative is (extension, sources), where sources is a tuple of 
+		(source key, plan for that key), for each source of the extension that 
+		is not present.  Alternatives where all the sources are present come 
+		first, then those that need more extending to get their sources, both 
+		in the original extension order.  The plans for the sources are 
+		separate, rather than multiplied out into every combination, so that 
+		each source is resolved as it would be on its own.
+
+		Plans are compiled once per class and set of present keys, since 
+		records flowing through a pipeline nearly always have the same keys.
+		"""
+		try:
+			return cls._plans[key, present]
+		except KeyError:
+			plan = cls._compile_plan(key, present, frozenset(), {}, {})
+			if len(cls._plans) >= MAX_PLANS:
+				cls._plans.clear()
+			cls._plans[key, present] = plan
+			return plan
+
+	@classmethod
+	def _compile_plan(cls, key, present, pending, plans, upstream):
+		"""Compile the plan for key; see _plan.
+
+		:param pending: the keys further up the chain that are waiting on this 
+			one; extensions that would need one of those are part of a cycle, 
+			and they are left out of the plan
+		:param plans: the plans compiled so far, by key and the keys in 
+			pending that it depends on (see _upstream), so that a key that's 
+			a source of many others is compiled once, not once per way to it
+		:param upstream: the cache for _upstream
+		"""
+		relevant = pending & cls._upstream(key, present, upstream)
+		try:
+			return plans[key, relevant]
+		except KeyError:
+			pass
+		plan = plans[key, relevant] = cls._compile_alternatives(key, present, pending | frozenset((key,)), plans, upstream)
+		return plan
+
+	@classmethod
+	def _upstream(cls, key, present, cache):
+		"""Return the set of keys not present that key may be extended from, 
+		directly or not.
+
+		Only these in pending can affect the plan for key.
+		"""
+		try:
+			return cache[key]
+		except KeyError:
+			pass
+		keys = set()
+		todo = [key]
+		while todo:
+			for e in cls._extensions_by_target.get(todo.pop(), ()):
+				for sk in e.source:
+					if sk not in present and sk not in keys:
+						keys.add(sk)
+						todo.append(sk)
+		keys = cache[key] = frozenset(keys)
+		return keys
+
+	@classmethod
+	def _compile_alternatives(cls, key, present, pending, plans, upstream):
+		"""Return the alternatives of the plan for key; see _compile_plan."""
+
+		direct = []  #alternatives where we already have all sources
+		indirect = []  #alternatives where one or more of the sources need extending first
+
+		for e in cls._extensions_by_target.get(key, ()):
+			missing = [ sk for sk in e.source if sk not in present ]
+			if not missing:
+				direct.append((e, ()))
+				continue
+
+			if pending.intersection(missing):
+				_log.debug(
+					'skipping %r for %r, since it is part of an extension cycle' % (e, key)
+				)
+				continue
+
+			sources = []
+			for sk in missing:
+				subplan = cls._compile_plan(sk, present, pending, plans, upstream)
+				if not subplan:
+					break
+				sources.append((sk, subplan))
+			else:
+				indirect.append((e, tuple(sources)))
+
+		return tuple(direct + indirect)
+
+
+class LazyDict(LazyBase, dict):
+	"""a dict with transparent, on-demand computation and optimizable memoization
+
+	See the module documentation for the general overview.
+
+	To implement a LazyDict, simply inherit from this base class and define the 
+	class variable `extensions', a list of Extension instances.  The order 
+	matters -- extensions are attempted roughly in order.  It's also extremely 
+	good practice to document the expected keys and their value types in the 
+	class doc.  The extensions are indexed by target key when the class is 
+	created (see LazyDictType), so to change them later, reassign the class 
+	variable rather than modifying the list in place.
+
+	__getattr__ and related methods will raise KeyError if the data is not 
+	present, such as:
+
+		* the key(s) necessary to compute the values through extensions are not 
+		  present
+
+		* there is no extension that computes the value for that key
+
+		* data extension is limited by the laziness setting
+
+	There are two `special' keys:
+
+		_laziness: the laziness setting (see module doc)
+
+		_overwrite: the overwrite setting (see module doc)
+
+	Key values are never None -- that special value is used internally during 
+	extension evaluation.  This might change, we'll see what problems we run 
+	into...
+	"""
+
+
+	#--- raw access (see LazyBase)
+
+	_raw_get = dict.__getitem__
+	_raw_contains = dict.__contains__
+	_raw_keys = dict.__iter__
+	_raw_setting = dict.get
+
+
+	def __getitem__(self, key):
+		"""dict's __getitem__, with transparent LazyDict semantics.
+
+		If the key is not present, this computes it through extensions if 
+		possible (see LazyBase._lookup).
+
+		This method itself is rather optimized for LAZINESS_QUERY_OPTIMIZED, as 
+		it usually uses EAFP (try/except) over of LBYL (if/hasattr), which 
+		assumes success will be more frequent than failure.
+		"""
 		try:
 			#EAFP -- hopefully we already have it, in which case just return it
 			return dict.__getitem__(self, key)
 		except KeyError:
-			if dict.get(self,'_laziness',DEFAULT_LAZINESS) == LAZINESS_LOCKED:
-				#if extending is not allowed, we don't have it, and we're done
-				raise
+			return self._lookup(key)
+
+
+#--- compact records
+
+_missing = object()  #the value of unset slots, as returned by getattr()
+
+class CompactRecord(LazyBase):
+	"""The base of compact, fixed-schema records; see compact().
+
+	Values for the keys of the schema are stored in slots, and any other keys
+	in a dict that's only created if needed, so a record costs a fraction of
+	the memory of a dict.  It has the mapping interface of a LazyDict, and is
+	extended the same way, but it is not a dict.  (Where a real dict is needed,
+	e.g. to encode it, use dict(d), or pre_serialize.)
+
+	The __class__ key that records are tagged with when serialized is not
+	stored, since it's the record's class itself.
+	"""
+
+	__slots__ = ('_extra',)
+
+	_keys = ()  #the schema, in order
+	_slots = {}  #slot name by key
+	_slot_items = ()  #(key, slot name) for each key of the schema
+
+
+	def __init__(self, *args, **kwargs):
+		self.update(*args, **kwargs)
+
+
+	#--- raw access (see LazyBase)
+
+	def _raw_get(self, key):
+		slot = self._slots.get(key)
+		try:
+			if slot is not None:
+				return getattr(self, slot)
+			return self._extra[key]
+		except AttributeError:
+			raise KeyError(key)
+
+	def _raw_contains(self, key):
+		slot = self._slots.get(key)
+		if slot is not None:
+			return hasattr(self, slot)
+		try:
+			return key in self._extra
+		except AttributeError:
+			return False
+
+	def _raw_keys(self):
+		for k, slot in self._slot_items:
+			if hasattr(self, slot):
+				yield k
+		try:
+			extra = self._extra
+		except AttributeError:
+			return
+		for k in extra:
+			yield k
+
+	def _raw_setting(self, key, default):
+		try:
+			return self._extra.get(key, default)
+		except AttributeError:
+			return default
+
+
+	#--- the mapping interface, which is raw, like dict's, except for
+	#--- __getitem__, __contains__, and has_key
+
+	def __getitem__(self, key):
+		"""dict's __getitem__, with transparent LazyDict semantics."""
+		try:
+			return self._raw_get(key)
+		except KeyError:
+			return self._lookup(key)
+
+	def __setitem__(self, key, value):
+		slot = self._slots.get(key)
+		if slot is not None:
+			setattr(self, slot, value)
+		else:
+			try:
+				self._extra[key] = value
+			except AttributeError:
+				self._extra = {key: value}
+
+	def __delitem__(self, key):
+		slot = self._slots.get(key)
+		try:
+			if slot is not None:
+				delattr(self, slot)
 			else:
-				#try to compute it through extensions
-
-				fulfilled = False  #if we've satisfied the main request
-				
-				e1 = []  #candidate extensions where we already have all sources, w/o further extending
-				         #try these first, since they are the most efficient, and to avoid infinite loops
-				e2 = []  #candidate extensions where one or more of the sources are only available through extension, if at all
-				         #invoking these can cause recursion, which may be infinite
-				
-				#sort the extensions into the above two categories (original order is preserved within a category)
-				for e in self.extensions:
-					if key in e.target:
-						if all([ (dict.__contains__(self, sk)) for sk in e.source ]):  #using dict, so no extending, no recursion
-							e1.append(e)
-						else:
-							e2.append(e)
-
-				#try each candidate extension
-				for sources_known_present, e in chain(izip(repeat(True), e1), izip(repeat(False), e2)):
-					if sources_known_present or all([ (sk in self) for sk in e.source ]):  #(sk in self) makes this recursive and allows for extension chaining
-						#we have all the required source values; run the extension
-						logging.getLogger('dio.lazydict.extension').debug(repr(e))
-						LazyDict._extension_count += 1
-						for k, v in izip(e.target, e(*[ dict.__getitem__(self, sk) for sk in e.source ])):
-							if v is not None:
-								if k == key:
-									#this is the key we want -- store the value
-									self[k] = v
-									fulfilled = True
-									if dict.get(self,'_laziness',DEFAULT_LAZINESS) == LAZINESS_DATA_OPTIMIZED:
-										#we have what we need and don't care about the rest of the target data
-										break
-								elif dict.get(self,'_laziness',DEFAULT_LAZINESS) == LAZINESS_QUERY_OPTIMIZED:
-									#this is not the key that we want, but store the value so we don't have to re-query
-									#but only if it's not already there or the instance is configured to update existing data
-									if not dict.__contains__(self,k) or dict.get(self,'_overwrite',DEFAULT_OVERWRITE) == OVERWRITE_UPDATE:
-										self[k] = v
-					if fulfilled: break
-				
-				return dict.__getitem__(self, key)  #(may still raise KeyError)
+				del self._extra[key]
+		except AttributeError:
+			raise KeyError(key)
+
+	def __iter__(self):
+		return self._raw_keys()
+
+	def __len__(self):
+		n = 0
+		for k in self._raw_keys():
+			n += 1
+		return n
+
+	def iterkeys(self):
+		return self._raw_keys()
+
+	def keys(self):
+		return list(self._raw_keys())
+
+	def iteritems(self):
+		for k, slot in self._slot_items:
+			v = getattr(self, slot, _missing)
+			if v is not _missing:
+				yield k, v
+		try:
+			extra = self._extra
+		except AttributeError:
+			return
+		for item in extra.iteritems():
+			yield item
+
+	def items(self):
+		return list(self.iteritems())
+
+	def itervalues(self):
+		for k, v in self.iteritems():
+			yield v
+
+	def values(self):
+		return list(self.itervalues())
+
+	def get(self, key, default=None):
+		try:
+			return self._raw_get(key)
+		except KeyError:
+			return default
+
+	def pop(self, key, *default):
+		try:
+			v = self._raw_get(key)
+		except KeyError:
+			if default:
+				return default[0]
+			raise
+		del self[key]
+		return v
+
+	def setdefault(self, key, default=None):
+		try:
+			return self._raw_get(key)
+		except KeyError:
+			self[key] = default
+			return default
+
+	def update(self, *args, **kwargs):
+		"""dict's update, except that the __class__ key is ignored."""
+		for other in args + (kwargs,):
+			if hasattr(other, 'iteritems'):
+				other = other.iteritems()
+			for k, v in other:
+				if k != '__class__':
+					self[k] = v
+
+	def clear(self):
+		for k in self.keys():
+			del self[k]
+
+	def copy(self):
+		return self.__class__(self.iteritems())
+
+	def __eq__(self, other):
+		if isinstance(other, CompactRecord):
+			other = dict(other.iteritems())
+		elif not isinstance(other, dict):
+			return NotImplemented
+		return dict(self.iteritems()) == other
+
+	def __ne__(self, other):
+		eq = self.__eq__(other)
+		if eq is NotImplemented:
+			return eq
+		return not eq
+
+	__hash__ = None
+
+	def __repr__(self):
+		return '%s(%r)' % (self.__class__.__name__, dict(self.iteritems()))
+
+	def __reduce__(self):
+		return (self.__class__, (dict(self.iteritems()),))
+
+def compact(cls, keys=None, name=None):
+	"""Return a compact record class for the schema of LazyDict class cls.
+
+	:param keys: the keys of the schema (default: cls._keys)
+	:param name: the name of the new class (default: 'Compact' + the name of
+		cls)
+
+	The new class has the extensions of cls (as of now).  For records of it to
+	be deserialized, it must be importable under its name from the module of
+	cls, e.g.:
+
+		CompactExampleLazyDict = lazydict.compact(ExampleLazyDict)
+
+	or registered with dio.register_class().  For a plain schema without
+	extensions, use LazyDict as cls.
+	"""
+	if keys is None:
+		keys = cls._keys
+	if name is None:
+		name = 'Compact' + cls.__name__
+
+	unique = []
+	for k in keys:
+		if k not in unique:
+			unique.append(k)
+	slots = tuple([ '_%d' % i for i in xrange(len(unique)) ])
+
+	return LazyDictType(name, (CompactRecord,), {
+		'__doc__': 'A compact record with the schema and extensions of %s.' % cls.__name__,
+		'__module__': cls.__module__,
+		'__slots__': slots,
+		'_keys': tuple(unique),
+		'_slots': dict(izip(unique, slots)),
+		'_slot_items': tuple(izip(unique, slots)),
+		'extensions': cls.extensions,
+	})
+
+
+#--- batched extension
+
+def _first_steps(plan, key):
+	"""Return the list of (extension, key) steps of the first alternative of 
+	plan, including those of the first alternatives for its sources, in the 
+	order to run them."""
+	e, sources = plan[0]
+	steps = []
+	for sk, subplan in sources:
+		steps.extend(_first_steps(subplan, sk))
+	steps.append((e, key))
+	return steps
+
+def prefetch(ds, keys):
+	"""Compute the given keys for many LazyDicts, with batched extension calls.
+
+	:param ds: the dicts; any that are not LazyDicts (or compact records) are
+		ignored
+	:param keys: the keys to compute
+
+	The dicts are grouped by class and set of present keys, so that each group 
+	shares a resolution plan (see LazyDict._plan).  Each step of the plan's 
+	first alternative (see _first_steps) is then run for the whole group with 
+	one call to the extension's call_batch().  Any dicts for which that does 
+	not work out are left as is, to be extended on demand as usual.  Settings 
+	for laziness and overwriting are honored as usual.
+	"""
+	for key in keys:
+		groups = {}
+		for d in ds:
+			if isinstance(d, LazyBase) and not d._raw_contains(key) \
+				and d._raw_setting('_laziness',DEFAULT_LAZINESS) != LAZINESS_LOCKED:
+				groups.setdefault((d.__class__, frozenset(d._raw_keys())), []).append(d)
+
+		for (cls, present), group in groups.iteritems():
+			plan = cls._plan(key, present)
+			if not plan:
+				continue
+			for e, k in _first_steps(plan, key):
+				todo = []
+				sources = []
+				for d in group:
+					if not d._raw_contains(k):
+						args = d._sources(e)
+						if args is not None:
+							todo.append(d)
+							sources.append(args)
+				if not todo:
+					continue
+
+				if _extension_log.isEnabledFor(logging.DEBUG):
+					_extension_log.debug('%r x %d' % (e, len(todo)))
+				LazyBase._extension_count += 1
+
+				if TELEMETRY:
+					t = time.time()
+					results = e._evaluate_batch(sources)
+					e._record(key, PATH_BATCH, len(todo), time.time() - t)
+				else:
+					results = e._evaluate_batch(sources)
+
+				for d, values in izip(todo, results):
+					d._store(e, k, values)
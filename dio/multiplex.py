@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""many concurrent input streams into one pipeline
+
+json_in reads one stream at a time, so a pipeline over many slow streams (e.g.
+pipes from other processes, or network connections) waits on each in turn, and
+the usual workaround is one process per stream.  multiplex_in instead waits on
+all of them at once, with poll(2) (or select(2) where that's missing), and
+sends each record on as soon as its line is complete:
+
+	dio.multiplex.multiplex_in([sock1, sock2, pipe3], key='stream',
+		out=dio.filter(lambda d: d['x'] > 10)
+	)
+
+It's an ordinary source, so the rest of the pipeline is made of the usual
+processors.  There's backpressure for free: while the pipeline works on a
+record, no more is read, so streams that get ahead fill their kernel buffers
+and their writers block.  Each stream is read at most chunk_size bytes at a
+time, so one fast stream can't starve the others.
+"""
+
+
+import os, select
+
+from dio import processor, errors, codec, post_deserialize
+
+
+DEFAULT_READ_SIZE = 64*1024  #bytes read from a ready stream at once
+
+
+class _Stream(object):
+	"""The state of one input stream."""
+	__slots__ = ('fd', 'name', 'buf', 'types')
+	def __init__(self, fd, name):
+		self.fd = fd
+		self.name = name
+		self.buf = ''  #the incomplete last line read so far
+		self.types = {}  #its type ids, see dio.post_deserialize
+
+def _poller(fds):
+	"""Return a function of a timeout that returns the fds ready to read, and
+	a function to stop waiting on an fd."""
+	if hasattr(select, 'poll'):
+		p = select.poll()
+		for fd in fds:
+			p.register(fd, select.POLLIN | select.POLLPRI)
+		def ready(timeout=None):
+			return [ fd for fd, event in p.poll(timeout) ]
+		return ready, p.unregister
+	else:
+		fds = set(fds)
+		def ready(timeout=None):
+			if timeout is not None:
+				timeout = timeout / 1000.0
+			return select.select(list(fds), [], [], timeout)[0]
+		return ready, fds.discard
+
+@processor
+def multiplex_in(inns, raw=False, key=None, chunk_size=DEFAULT_READ_SIZE, out=None, err=None):
+	"""Read JSON dicts from all the given streams, as they're ready.
+
+	:param inns: the input streams, file-like objects with a fileno() (files,
+		pipes, sockets), or file descriptors; they're read with os.read(), not
+		through any buffering of the file-like objects, and are not closed
+	:param raw: as for dio.json_in
+	:param key: if given, each dict gets this key, whose value is the index in
+		inns of the stream it came from
+	:param chunk_size: the most bytes to read from a ready stream at once
+
+	The order of the dicts from any one stream is kept.  A line that can't be
+	decoded is an error sent to err, and doesn't stop the rest of its stream or
+	the others.  Type ids are tracked per stream.
+	"""
+	RawRecord = codec.RawRecord
+	decode = codec.decode
+
+	streams = {}
+	for i, inn in enumerate(inns):
+		if isinstance(inn, (int, long)):
+			fd = inn
+		else:
+			fd = inn.fileno()
+		streams[fd] = _Stream(fd, i)
+	ready, forget = _poller(streams.keys())
+
+	while streams:
+		for fd in ready():
+			s = streams.get(fd)
+			if s is None:
+				continue
+			data = os.read(fd, chunk_size)
+			if data:
+				lines = (s.buf + data).split('\n')
+				s.buf = lines.pop()
+			else:
+				#end of the stream; the last line may have no newline
+				lines = [s.buf]
+				del streams[fd]
+				forget(fd)
+
+			for line in lines:
+				if not line or line.isspace():
+					continue
+				if raw and '"__class__"' not in line:
+					d = RawRecord(line)
+				else:
+					try:
+						d = post_deserialize(decode(line), s.types)
+					except Exception, e:
+						err.send(errors.e2d(e))
+						continue
+					if d is None:
+						continue
+				if key is not None:
+					d[key] = s.name
+				out.send(d)
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""pipelines of the command line processors, in one process
+
+A pipeline is written like a shell pipeline of the dio.* commands, without
+the dio. prefixes, e.g.:
+
+	filter %x -gt 10 | tidy x y | sort y
+
+Running that with bin/dio wires the processors together in a single Python
+process, so that records are not encoded and decoded between stages, and there
+is only one interpreter to start.  The stages and their arguments are below.
+Those marked * exist only in pipelines, not as dio.* commands, and sort's
+--reverse is only in pipelines too; the rest take the same arguments as the
+commands.
+
+	identity
+	filter CONDITION...     see dio.condition
+	tidy KEY...
+	strip KEY...
+	sort [--reverse] [KEY...]
+	uniq
+	head N                  *
+	wc
+	count [--partial] [--combine]
+	sum [--partial] [--combine]
+	average [--partial] [--combine]
+	top [--min] N [KEY...]
+	min N KEY               *
+	max N KEY               *
+"""
+
+
+import shlex
+
+import dio
+from dio import coreutils, condition
+
+
+class PipelineError(ValueError):
+	"""A pipeline specification that can't be built."""
+	pass
+
+
+#--- the stages
+
+#each is a function of the stage's arguments, out, and err, that returns the
+#processor; where there's a dio.* command of the same name, the arguments are
+#parsed the same as it parses them (plus sort's --reverse)
+
+def _flags(args, *flags):
+	"""Remove the given flags from args, and return whether each was there."""
+	present = []
+	for f in flags:
+		present.append(f in args)
+		while f in args:
+			args.remove(f)
+	return present
+
+def _int(name, s):
+	try:
+		return int(s)
+	except ValueError:
+		raise PipelineError('%s: not a number: %r' % (name, s))
+
+def _nargs(name, args, n):
+	if len(args) != n:
+		raise PipelineError('%s takes %d argument%s' % (name, n, '' if n==1 else 's'))
+
+def _identity(args, out, err):
+	_nargs('identity', args, 0)
+	return dio.identity(out=out, err=err)
+
+def _filter(args, out, err):
+	try:
+		f = condition.compile_tokens(args)
+	except SyntaxError, e:
+		raise PipelineError('filter: invalid condition %r: %s' % (' '.join(args), e))
+	return dio.filter(f, out=out, err=err)
+
+def _tidy(args, out, err):
+	return dio.tidy(args, out=out, err=err)
+
+def _strip(args, out, err):
+	return dio.strip(args, out=out, err=err)
+
+def _sort(args, out, err):
+	reverse, = _flags(args, '--reverse')
+	return coreutils.sort(args, reverse=reverse, out=out, err=err)
+
+def _uniq(args, out, err):
+	_nargs('uniq', args, 0)
+	return coreutils.uniq(out=out, err=err)
+
+def _head(args, out, err):
+	_nargs('head', args, 1)
+	return coreutils.head(_int('head', args[0]), out=out, err=err)
+
+def _wc(args, out, err):
+	_nargs('wc', args, 0)
+	return coreutils.wc(out=out, err=err)
+
+def _reducer(name, f):
+	def build(args, out, err):
+		partial, combine = _flags(args, '--partial', '--combine')
+		_nargs(name, args, 0)
+		return f(partial=partial, combine=combine, out=out, err=err)
+	return build
+
+def _top(args, out, err):
+	reverse, = _flags(args, '--min')
+	if not args:
+		raise PipelineError('top needs N')
+	return dio.top(_int('top', args[0]), args[1:], reverse=reverse, out=out, err=err)
+
+def _minmax(name, f):
+	def build(args, out, err):
+		_nargs(name, args, 2)
+		return f(_int(name, args[0]), args[1], out=out, err=err)
+	return build
+
+stages = {
+	'identity': _identity,
+	'filter': _filter,
+	'tidy': _tidy,
+	'strip': _strip,
+	'sort': _sort,
+	'uniq': _uniq,
+	'head': _head,
+	'wc': _wc,
+	'count': _reducer('count', dio.count),
+	'sum': _reducer('sum', dio.sum_),
+	'average': _reducer('average', dio.average),
+	'top': _top,
+	'min': _minmax('min', dio.min_),
+	'max': _minmax('max', dio.max_),
+}
+
+#the stages that only pass on (some of) the records they're given, unchanged,
+#and so may be given raw records (see dio.json_in)
+raw_stages = set(('identity', 'filter', 'uniq', 'head'))
+
+
+#--- building
+
+def parse(args):
+	"""Return the list of (name, args) of the stages of a pipeline.
+
+	:param args: the command line arguments: either the whole pipeline as one
+		string, which is split like a shell would, or the tokens of it, with
+		the pipes as separate '|' tokens
+
+	Raises PipelineError if a stage is unknown.
+	"""
+	if len(args) == 1:
+		args = shlex.split(args[0])
+
+	specs = []
+	tokens = []
+	for tok in list(args) + ['|']:
+		if tok == '|':
+			if not tokens:
+				raise PipelineError('empty stage')
+			name = tokens[0]
+			if name.startswith('dio.'):
+				name = name[4:]
+			if name not in stages:
+				raise PipelineError('unknown stage %r (the stages are: %s)' % (tokens[0], ', '.join(sorted(stages))))
+			specs.append((name, tokens[1:]))
+			tokens = []
+		else:
+			tokens.append(tok)
+	return specs
+
+def build(specs, out=None, err=None):
+	"""Return the first processor of the pipeline of the given stages.
+
+	:param specs: a list of (name, args), as returned by parse()
+	:param out, err: where the last stage sends its output and errors
+		(default: dio.default_out and dio.default_err)
+
+	Raises PipelineError if the arguments of a stage are bad.
+	"""
+	if out is None: out = dio.default_out
+	if err is None: err = dio.default_err
+	p = out
+	for name, args in reversed(specs):
+		p = stages[name](list(args), p, err)
+	return p
+
+def is_raw(specs):
+	"""Return whether the pipeline of the given stages can take raw records."""
+	return all([ name in raw_stages for name, args in specs ])
+
+def run(args, inn=None, out=None, err=None):
+	"""Run the pipeline in args (see parse()) over dio.default_in.
+
+	:param inn: the input file (default: that of dio.default_in)
+
+	The pipeline is closed at the end, so what its stages send when closed
+	(e.g. sort's output) is sent before this returns.
+	"""
+	specs = parse(args)
+	kwargs = {}
+	if inn is not None:
+		kwargs['inn'] = inn
+	p = build(specs, out=out, err=err)
+	try:
+		dio.default_in(raw=is_raw(specs), out=p, **kwargs)
+	finally:
+		p.close()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""a daemon that runs pipelines for thin clients, over a Unix socket
+
+Starting a dio command costs an interpreter, the imports, and LazyDict classes
+with nothing yet worked out (e.g. the extension plans, see dio.lazydict).
+When many tiny pipelines are run, e.g. from cron, that's most of the work.
+Instead, run the daemon once:
+
+	dio serve /path/to/socket
+
+and point bin/dio at it:
+
+	export DIO_SOCKET=/path/to/socket
+	dio 'filter %x -gt 10 | tidy x'
+
+bin/dio then only forwards its arguments, stdin, stdout, and stderr, without
+importing dio at all.  If the daemon is not there, it runs the pipeline itself,
+as usual.  Each connection is handled in a thread of its own, and all share the
+daemon's imports and classes.  The daemon's sys.path must include the modules
+of any LazyDict classes in the input.  Since a pipeline can run arbitrary code
+(e.g. filter conditions are Python expressions), the socket is only usable by
+the daemon's user.
+
+The protocol, on a connection:
+
+	client: the length of the arguments, in bytes, and a newline
+	client: the arguments, joined with NULs
+	client: the input (stdin), until it shuts down its side for writing
+
+	server: any number of chunks of output, each a channel (o for stdout, e
+	        for stderr), a space, the length of the data, a newline, and the
+	        data
+	server: x, a space, the exit status, and a newline
+"""
+
+
+import sys, os, errno, signal, socket, SocketServer, traceback
+
+import dio
+from dio import pipeline, instrument
+
+
+class _Channel(object):
+	"""A file-like object that writes chunks of one channel."""
+
+	def __init__(self, f, name):
+		self.f = f
+		self.name = name
+
+	def write(self, s):
+		if s:
+			self.f.write('%s %d\n%s' % (self.name, len(s), s))
+
+	def flush(self):
+		pass
+
+def handle(inn, out):
+	"""Run the pipeline of one request, read from inn, and reply to out.
+
+	Returns the exit status, or None if there's no request (e.g. the
+	connection was only to check that the daemon is there).
+	"""
+	header = inn.readline()
+	if not header:
+		return None
+	n = int(header)
+	args = inn.read(n).split('\0') if n else []
+
+	stdout = _Channel(out, 'o')
+	stderr = _Channel(out, 'e')
+
+	#the statistics of this pipeline, if any (see dio.instrument), are kept
+	#apart from those of the others, sent to the client's stderr as a dio
+	#command would send them, and then forgotten
+	stats = instrument.enabled
+	if stats:
+		instrument.begin()
+	try:
+		try:
+			specs = pipeline.parse(args)
+			json_out = dio.json_out(out=stdout, type_ids=dio.DEFAULT_TYPE_IDS)
+			json_err = dio.json_out(out=stderr, buffer_size=0, type_ids=dio.DEFAULT_TYPE_IDS)
+			p = pipeline.build(specs, out=json_out, err=json_err)
+		except pipeline.PipelineError, e:
+			stderr.write('dio: %s\n' % e)
+			return 2
+
+		try:
+			dio.json_in(inn=inn, raw=pipeline.is_raw(specs), out=p)
+			p.close()
+			json_out.close()
+			if stats:
+				instrument.emit(out=json_err)
+			json_err.close()
+		except socket.error:
+			raise
+		except Exception:
+			stderr.write(traceback.format_exc())
+			return 1
+		return 0
+	finally:
+		if stats:
+			instrument.end()
+
+class _Handler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		try:
+			status = handle(self.rfile, self.wfile)
+			if status is not None:
+				self.wfile.write('x %d\n' % status)
+		except socket.error, e:
+			#the client went away
+			if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+				raise
+
+	def finish(self):
+		try:
+			SocketServer.StreamRequestHandler.finish(self)
+		except socket.error, e:
+			if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+				raise
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	"""The daemon; see serve()."""
+	daemon_threads = True
+
+	def __init__(self, path):
+		if os.path.exists(path):
+			#remove it if it's left over from a daemon that's gone
+			s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				try:
+					s.connect(path)
+				except socket.error, e:
+					if e.errno != errno.ECONNREFUSED:
+						raise
+					os.unlink(path)
+				else:
+					raise socket.error(errno.EADDRINUSE, 'already serving on %s' % path)
+			finally:
+				s.close()
+		SocketServer.UnixStreamServer.__init__(self, path, _Handler, bind_and_activate=False)
+		self.path = path
+		try:
+			self.server_bind()
+			#before listening, so no one else can ever connect
+			os.chmod(path, 0600)
+			self.server_activate()
+		except:
+			self.server_close()
+			raise
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+def serve(path):
+	"""Serve pipelines on the Unix socket at path, until interrupted or
+	terminated."""
+	server = Server(path)
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+	finally:
+		server.server_close()
+
+def main(args):
+	"""The entry point of `dio serve [PATH]'; PATH defaults to $DIO_SOCKET."""
+	if args:
+		path = args[0]
+	else:
+		path = os.environ.get('DIO_SOCKET')
+	if len(args) > 1 or not path:
+		sys.stderr.write('usage: dio serve [PATH]  (PATH defaults to $DIO_SOCKET)\n')
+		return 2
+	try:
+		serve(path)
+	except socket.error, e:
+		sys.stderr.write('dio: %s\n' % e)
+		return 1
+	return 0
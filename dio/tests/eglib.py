@@ -104,6 +104,10 @@ class ExampleLazyDict(lazydict.LazyDict):
 	]
 
 
+#the compact version of it
+CompactExampleLazyDict = lazydict.compact(ExampleLazyDict)
+
+
 #--- some processors
 
 @processor
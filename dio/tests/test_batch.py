@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""unit tests"""
+
+
+import string, unittest
+import dio
+import dio.batch
+import dio.coreutils
+
+import settings
+from eglib import ExampleLazyDict
+
+
+class BatchTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+	def test_source_batch_sizes(self):
+		"""Test that batches are of the requested size (except the last)."""
+		dio.batch.source(({'i':i} for i in xrange(10)), size=4)
+
+		self.assertEqual([ len(b) for b in self.out ], [4, 4, 2])
+
+	def test_batch_unbatch(self):
+		"""Test round-tripping through the adapters."""
+		dio.source(({'i':i} for i in xrange(10)),
+			out=dio.batch.batch(3,
+				out=dio.batch.unbatch()
+			)
+		)
+
+		self.assertEqual(self.out, [ {'i':i} for i in xrange(10) ])
+
+	def test_filter_tidy(self):
+		"""Test batch-mode filter and tidy, including through extensions."""
+		dio.batch.source(( ExampleLazyDict(x=x, y=1) for x in xrange(10) ), size=3,
+			out=dio.batch.filter(lambda d: d['x'] % 2 == 0,
+				out=dio.batch.tidy(('sum',),
+					out=dio.batch.unbatch()
+				)
+			)
+		)
+
+		self.assertEqual(self.out, [ {'sum':x+1} for x in xrange(0, 10, 2) ])
+
+	def test_errors_do_not_lose_batch(self):
+		"""Test that one bad record does not take down its whole batch."""
+		dio.batch.source([ {'letter':c} for c in 'abc' ] + [ {} ],
+			out=dio.batch.filter(lambda d: d['letter'] != 'b',
+				out=dio.batch.unbatch()
+			)
+		)
+
+		self.assertEqual(self.out, [ {'letter':'a'}, {'letter':'c'} ])
+		self.assertEqual(len(self.err), 1)
+		self.assertTrue(self.err[0].has_key('error'))
+
+	def test_each(self):
+		"""Test running per-record processors inside a batch pipeline."""
+		dio.batch.source(({"name":n} for n in ('foo', 'foo', 'bar', 'bar')), size=3,
+			out=dio.batch.each(dio.coreutils.uniq,
+				out=dio.batch.each(dio.tidy, ('name',),
+					out=dio.batch.unbatch()
+				)
+			)
+		)
+
+		self.assertEqual(self.out, [ {"name":"foo"}, {"name":"bar"} ])
+
+	def test_each_reducer(self):
+		"""Test that what a per-record reducer emits on close is passed on."""
+		dio.batch.source(({"name":c} for c in string.ascii_letters), size=5,
+			out=dio.batch.each(dio.coreutils.wc)
+		)
+
+		self.assertEqual(self.out, [ [ {"count":len(string.ascii_letters)} ] ])
+
+	def test_each_early_termination(self):
+		"""Test that a per-record processor that stops early stops the batch pipeline."""
+		dio.batch.source(({'i':i} for i in xrange(100)), size=3,
+			out=dio.batch.each(dio.coreutils.head, 4,
+				out=dio.batch.unbatch()
+			)
+		)
+
+		self.assertEqual(self.out, [ {'i':i} for i in xrange(4) ])
+
+
+if __name__=='__main__':
+	unittest.main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""unit tests"""
+
+
+import time, cStringIO, unittest
+import dio
+import dio.binary
+
+import settings
+from eglib import ExampleLazyDict
+
+
+class BinaryTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+		self.inn = [ {'i':i, 's':'x'*i} for i in xrange(95) ] + [ ExampleLazyDict(x=1, y=2) ]
+
+	def write(self, **kwargs):
+		fout = cStringIO.StringIO()
+		dio.source(self.inn, out=dio.binary.binary_out(out=fout, block_size=10, **kwargs))
+		return fout.getvalue()
+
+	def test_round_trip(self):
+		"""Test writing and reading back, with each compression and decoder."""
+		for compression in (None, 'zlib', 'bz2'):
+			data = self.write(compression=compression)
+			for workers in (0, 2):
+				del self.out[:]
+				dio.binary.binary_in(inn=cStringIO.StringIO(data), workers=workers)
+				self.assertEqual(self.out, self.inn)
+				self.assertEqual(type(self.out[-1]), ExampleLazyDict)
+				self.assertEqual(self.out[-1]['sum'], 3)
+
+	def test_read_ahead(self):
+		"""Test that parallel decoding reads only so far ahead of the output."""
+		data = self.write()
+		index = dio.binary.read_index(cStringIO.StringIO(data))
+		inn = cStringIO.StringIO(data)
+		positions = []
+		@dio.processor
+		def slow(out=None, err=None):
+			while True:
+				d = yield
+				if not positions:
+					time.sleep(0.2)  #(for the pool to read all it will)
+				positions.append(inn.tell())
+				out.send(d)
+		dio.binary.binary_in(inn=inn, workers=2, out=slow())
+		self.assertEqual(self.out, self.inn)
+		self.assertTrue(positions[0] <= index[6][0])  #(1 output, 4 in flight, and 1 waiting)
+
+	def test_compression(self):
+		self.assertTrue(len(self.write(compression='zlib')) < len(self.write(compression=None)))
+
+	def test_index(self):
+		data = self.write()
+		index = dio.binary.read_index(cStringIO.StringIO(data))
+		self.assertEqual([ count for offset, count in index ], [10]*9 + [6])
+		self.assertEqual(index[0][0], len(dio.binary.MAGIC))
+
+	def test_range(self):
+		"""Test reading only some of the blocks."""
+		dio.binary.binary_in(inn=cStringIO.StringIO(self.write()), workers=0, start=2, stop=4)
+		self.assertEqual(self.out, self.inn[20:40])
+
+	def test_truncated(self):
+		"""Test that a stream without its index (e.g. cut short) is readable."""
+		data = self.write()
+		data = data[:dio.binary.read_index(cStringIO.StringIO(data))[-1][0]]
+		dio.binary.binary_in(inn=cStringIO.StringIO(data), workers=0)
+		self.assertEqual(self.out, self.inn[:90])
+
+	def test_not_binary(self):
+		self.assertRaises(dio.binary.FormatError,
+			dio.binary.binary_in, inn=cStringIO.StringIO('{"x": 1}\n'), workers=0
+		)
+
+
+if __name__=='__main__':
+	unittest.main()
@@ -33,6 +33,13 @@ echo '
 ./eg.send_one | dio.tidy sum
 #{"sum": 8, "__class__": "eglib.ExampleLazyDict"}
 
+echo "test type ids"
+DIO_TYPE_IDS=1 ./eg.send_one
+#{"1": "eglib.ExampleLazyDict", "__class__": "__types__"}
+#{"y": 5, "x": 3, "__class__": 1}
+DIO_TYPE_IDS=1 ./eg.send_one | dio.tidy sum
+#{"sum": 8, "__class__": "eglib.ExampleLazyDict"}
+
 echo "test eg.cli_of_python_pipeline"
 echo '
 {"x": 10, "y": 25}
@@ -56,6 +63,16 @@ echo '
 #{"foo": 3}
 #{"foo": 5}
 
+echo "test dio.sort (multiple keys)"
+echo '
+{"foo": 3, "bar": 1}
+{"foo": 1, "bar": 2}
+{"foo": 3, "bar": 0}
+' | dio.sort foo bar
+#{"foo": 1, "bar": 2}
+#{"foo": 3, "bar": 0}
+#{"foo": 3, "bar": 1}
+
 echo "test dio.uniq"
 echo '
 {"name": "foo"}
@@ -101,3 +118,16 @@ echo '
 #{"zzz": 3}
 #{"bar": 7}
 #{"foo": 11}
+
+
+#--- single-process pipelines
+
+echo "test dio"
+echo '
+{"x": 5, "y": 1}
+{"x": 20, "y": 3}
+{"x": 12, "y": 2}
+{"x": 12, "y": 2}
+' | dio 'filter %x -gt 10 | uniq | tidy x | sort x'
+#{"x": 12}
+#{"x": 20}
@@ -17,3 +17,11 @@ echo '
 {"foo": 42, "bar": 99}
 ' | dio.filter %foo -gt 10 -a \( %bar -eq "some string" -o True \)
 #{"foo": 42, "bar": 99}
+
+echo '
+{"name": "tmpfile", "foo": 2}
+{"name": "file.tmp", "foo": 6}
+{"name": "other", "foo": 7}
+' | dio.filter %name =~ '^tmp' -o %foo -in 6,8
+#{"name": "tmpfile", "foo": 2}
+#{"name": "file.tmp", "foo": 6}
@@ -31,6 +31,46 @@ echo '
 ' | dio.average
 
 
+
+#--- top
+
+echo '
+{"value": 24}
+{"value": 16}
+{"value":  8}
+{"value":  1}
+{"value":  1}
+' | dio.top 2 value
+#{"value": 24}
+#{"value": 16}
+
+echo '
+{"value": 24}
+{"value": 16}
+{"value":  8}
+{"value":  1}
+{"value":  1}
+' | dio.top --min 2 value
+#{"value": 1}
+#{"value": 1}
+
+
+#--- --partial and --combine
+
+#two shards of the above
+( echo '
+{"value": 24}
+{"value": 16}
+' | dio.average --partial
+echo '
+{"value":  8}
+{"value":  1}
+{"value":  1}
+' | dio.average --partial
+) | dio.average --combine
+#{"value": 10.0}
+
+
 #--- --groupby
 
 ##not implemented yet
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""unit tests"""
+
+
+import sys, os, shutil, tempfile, unittest
+import dio
+
+try:
+	import numpy
+	import dio.columnar
+except ImportError:
+	numpy = None
+
+import settings
+from eglib import ExampleLazyDict
+
+
+class ColumnarTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+		self.path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.path)
+
+	def write(self, inn, **kwargs):
+		dio.source(inn, out=dio.columnar.columnar_out(self.path, **kwargs))
+
+	def test_round_trip(self):
+		"""Test writing and reading back, across chunks, with missing keys."""
+		inn = [ {'i':i, 'f':i/2.0, 's':'x'*i} for i in xrange(25) ]
+		for d in inn[::3]:
+			d['sometimes'] = True
+		self.write(inn, chunk_size=10)
+
+		self.assertEqual(len([ f for f in os.listdir(self.path) if f.startswith('000002.') ]), 5)
+
+		dio.columnar.columnar_in(self.path)
+		self.assertEqual(self.out, inn)
+		self.assertEqual(self.err, [])
+
+	def test_mixed_types(self):
+		"""Test that columns of mixed or non-scalar values keep their values."""
+		inn = [ {'v':1}, {'v':'a'}, {'v':None}, {'v':[1, 2]}, {'v':{'k':1.5}} ]
+		self.write(inn)
+
+		dio.columnar.columnar_in(self.path)
+		self.assertEqual(self.out, inn)
+
+	def test_lazydict(self):
+		"""Test that LazyDicts are restored, with their extensions."""
+		self.write([ ExampleLazyDict(x=x, y=1) for x in xrange(3) ])
+
+		dio.columnar.columnar_in(self.path)
+		self.assertEqual([ type(d) for d in self.out ], [ ExampleLazyDict ] * 3)
+		self.assertEqual([ d['sum'] for d in self.out ], [1, 2, 3])
+
+	def test_lazydict_not_extended(self):
+		"""Test that LazyDicts are written with only the values they have."""
+		inn = [ ExampleLazyDict(x=1, y=2, sum=3), ExampleLazyDict(x=1, y=2) ]
+		self.write(inn)
+		self.assertFalse(dict.__contains__(inn[1], 'sum'))
+		self.assertFalse(dict.__contains__(inn[1], 'diff'))
+
+		dio.columnar.columnar_in(self.path)
+		self.assertTrue(dict.__contains__(self.out[0], 'sum'))
+		self.assertFalse(dict.__contains__(self.out[1], 'sum'))
+
+	def test_keys(self):
+		"""Test reading just some of the columns."""
+		self.write([ {'x':x, 'y':-x} for x in xrange(5) ])
+
+		dio.columnar.columnar_in(self.path, keys=('y',))
+		self.assertEqual(self.out, [ {'y':-x} for x in xrange(5) ])
+
+	def test_columns(self):
+		"""Test reading chunks as memory-mapped (and masked) arrays."""
+		self.write([ {'x':x} for x in xrange(5) ] + [ {'x':5, 'y':1} ], chunk_size=3)
+
+		dio.columnar.columnar_in(self.path, columns=True)
+		self.assertEqual(len(self.out), 2)
+		self.assertTrue(isinstance(self.out[0]['x'], numpy.memmap))
+		self.assertFalse(self.out[0].has_key('y'))
+		self.assertEqual(sum(c['x'].sum() for c in self.out), 15)
+		self.assertEqual(self.out[1]['y'].count(), 1)
+
+	def test_empty(self):
+		"""Test that an empty stream is still a readable dataset."""
+		self.write([])
+
+		dio.columnar.columnar_in(self.path)
+		self.assertEqual(self.out, [])
+
+
+if __name__=='__main__':
+	if numpy is None:
+		sys.stderr.write('numpy is not available; skipping %s\n' % __file__)
+		sys.exit(0)
+	unittest.main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""unit tests"""
+
+
+import unittest
+import dio
+import dio.batch
+from dio.condition import compile_tokens
+
+import settings
+
+
+class ConditionTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+	def check(self, tokens, ds, expected):
+		f = compile_tokens(tokens)
+		self.assertEqual([ d for d in ds if f(d) ], expected)
+		self.assertEqual(f.select(ds), expected)
+
+	def test_comparisons(self):
+		"""Test the test(1) syntax."""
+		ds = [ {'foo':i, 'bar':'x'} for i in xrange(10) ]
+		self.check(['%foo', '-gt', '5', '-a', '!', '%foo', '-eq', '7'], ds, [ {'foo':i, 'bar':'x'} for i in (6, 8, 9) ])
+		self.check(['(', '%foo', '<', '2', '-o', '%bar', '!=', 'x', ')'], ds, ds[:2])
+
+	def test_regex(self):
+		"""Test matching regular expressions."""
+		ds = [ {'name':'tmpfile'}, {'name':'file.tmp'}, {'name':42} ]
+		self.check(['%name', '=~', '^tmp'], ds, ds[:1])
+		self.check(['%name', '=~', 'tmp$', '-o', '%name', '=~', '^4'], ds, ds[1:])
+		self.check(['%name', '!~', 'tmp'], ds, ds[2:])
+
+	def test_membership(self):
+		"""Test membership in sets of literals."""
+		ds = [ {'v':1}, {'v':'a'}, {'v':2.5}, {'v':-3}, {'v':'b'} ]
+		self.check(['%v', '-in', '1,a,-3'], ds, [ ds[0], ds[1] ])
+		self.check(['%v', '-notin', '2.5,b'], ds, ds[:2] + ds[3:4])
+
+	def test_negative(self):
+		"""Test that a leading - makes a string, in sets as in comparisons."""
+		ds = [ {'v':-3}, {'v':'-3'} ]
+		self.check(['%v', '-eq', '-3'], ds, ds[1:])
+		self.check(['%v', '-in', '-3,4'], ds, ds[1:])
+
+	def test_syntax_errors(self):
+		"""Test that bad conditions fail when compiled."""
+		for tokens in ([], ['%v', '-in'], ['%v', '-gt']):
+			self.assertRaises(SyntaxError, compile_tokens, tokens)
+
+	def test_batch_filter(self):
+		"""Test batch filtering with select, and its fallback for errors."""
+		dio.batch.source([ {'v':1}, {'v':5}, {}, {'v':7} ], size=2,
+			out=dio.batch.filter(compile_tokens(['%v', '-gt', '2']),
+				out=dio.batch.unbatch()
+			)
+		)
+		self.assertEqual(self.out, [ {'v':5}, {'v':7} ])
+		self.assertEqual(len(self.err), 1)
+
+
+if __name__=='__main__':
+	unittest.main()
@@ -5,13 +5,13 @@
 
 """unit tests"""
 
-import time, unittest
+import sys, time, cPickle, cStringIO, unittest
 
 import dio
 from dio import lazydict
 
 import settings
-from eglib import ExampleLazyDict, x_age, x_math
+from eglib import ExampleLazyDict, CompactExampleLazyDict, x_age, x_math
 
 
 #--- TestCases
@@ -132,8 +132,109 @@ class LazyDictTestCase(unittest.TestCase):
 		)
 
 
+	def test_extensions_reassigned(self):
+		"""Test that reassigning extensions takes effect, even for subclasses."""
+		class Base(lazydict.LazyDict):
+			extensions = [ x_age() ]
+		class Sub(Base):
+			pass
+
+		self.assertRaises(KeyError, Sub(x=self.in_x, y=self.in_y).__getitem__, 'sum')
+
+		Base.extensions = [ x_math() ]
+
+		self.assertEqual(Base(x=self.in_x, y=self.in_y)['sum'], self.out_sum)
+		self.assertEqual(Sub(x=self.in_x, y=self.in_y)['sum'], self.out_sum)
+		self.assertRaises(KeyError, Sub(birthdate=self.in_birthdate).__getitem__, 'age')
+
+
+	def test_extension_cycle(self):
+		"""Test that cyclic extensions do not recurse infinitely."""
+		class x_p_to_q(lazydict.Extension):
+			source = ('p',)
+			target = ('q',)
+		class x_q_to_p(lazydict.Extension):
+			source = ('q',)
+			target = ('p',)
+		class Cyclic(lazydict.LazyDict):
+			extensions = [ x_p_to_q(), x_q_to_p() ]
+
+		self.assertRaises(KeyError, Cyclic(x=1).__getitem__, 'p')
+		self.assertEqual(Cyclic(p=1)['q'], 1)
+
+
 	#--- performance and laziness
 
+	def test_plan_chain(self):
+		"""Test that an extension chain compiles to a plan, once."""
+		present = frozenset(('a',))
+		plan = ExampleLazyDict._plan('c', present)
+
+		self.assertEqual(len(plan), 1)  #one alternative
+		self.assertEqual(
+			[ (e.__class__.__name__, k) for e, k in lazydict._first_steps(plan, 'c') ],
+			[ ('x_indirect1of2', 'b'), ('x_indirect2of2', 'c') ],
+		)
+
+		ExampleLazyDict(a=self.in_a)['c']
+		self.assertTrue(ExampleLazyDict._plan('c', present) is plan)
+
+	def test_plan_alternatives(self):
+		"""Test that deep chains of alternatives all resolve, without redoing
+		failed steps."""
+		class x_try(lazydict.Extension):
+			def __init__(self, source, target, works):
+				self.source = (source,)
+				self.target = (target,)
+				self.works = works
+			def __call__(self, v):
+				if self.works:
+					return v + 1,
+				return None,
+		class x_sum(lazydict.Extension):
+			source = ('a', 'b')
+			target = ('c',)
+			def __call__(self, a, b):
+				return a + b,
+
+		#two sources, each with five ways to get it, of which only the last works
+		class Wide(lazydict.LazyDict):
+			extensions = \
+				[ x_try('x', 'a', i == 4) for i in xrange(5) ] + \
+				[ x_try('x', 'b', i == 4) for i in xrange(5) ] + \
+				[ x_sum() ]
+		count = lazydict.LazyBase._extension_count
+		self.assertEqual(Wide(x=1)['c'], 4)
+		self.assertEqual(lazydict.LazyBase._extension_count - count, 11)
+
+		#a chain ten deep, with three ways to get each link, of which only the last works
+		class Deep(lazydict.LazyDict):
+			extensions = [ x_try('k%d' % i, 'k%d' % (i+1), j == 2) for i in xrange(10) for j in xrange(3) ]
+		count = lazydict.LazyBase._extension_count
+		self.assertEqual(Deep(k0=0)['k10'], 10)
+		self.assertEqual(lazydict.LazyBase._extension_count - count, 30)
+
+	def test_plan_compile_time(self):
+		"""Test that compiling a plan for a deep graph, with many ways to each 
+		key, takes time in proportion to its size, not its number of paths."""
+		class x_add(lazydict.Extension):
+			def __init__(self, source, target, n):
+				self.source = (source,)
+				self.target = (target,)
+				self.n = n
+			def __call__(self, v):
+				return v + self.n,
+		#each key from either of the two before it
+		n = 28
+		class Lattice(lazydict.LazyDict):
+			extensions = \
+				[ x_add('k%d' % (i-1), 'k%d' % i, 1) for i in xrange(2, n+1) ] + \
+				[ x_add('k%d' % (i-2), 'k%d' % i, 2) for i in xrange(2, n+1) ]
+		t = time.time()
+		self.assertEqual(Lattice(k0=0, k1=1)['k%d' % n], n)
+		self.assertTrue(time.time() - t < 1.0)
+		self.assertEqual(len(Lattice._plan('k%d' % n, frozenset(('k0', 'k1')))), 2)
+
 	def test_getitem_extension_done_once(self):
 		"""Test that the an extension is computed only once."""
 		d = ExampleLazyDict(name=self.in_name, birthdate=self.in_birthdate)
@@ -196,5 +297,183 @@ class LazyDictTestCase(unittest.TestCase):
 		)
 
 
+
+class TelemetryTestCase(unittest.TestCase):
+	def setUp(self):
+		self.telemetry = lazydict.TELEMETRY
+		lazydict.TELEMETRY = True
+		lazydict.telemetry_clear()
+
+	def tearDown(self):
+		lazydict.TELEMETRY = self.telemetry
+		lazydict.telemetry_clear()
+
+	def test_paths(self):
+		"""Test telemetry by key and path."""
+		d = ExampleLazyDict(x=1, y=2, a=1)
+		d['sum']
+		d['c']  #(b, then c)
+		lazydict.prefetch([ ExampleLazyDict(x=x, y=1) for x in xrange(3) ], ('diff',))
+
+		by = dict([ ((t['extension'], t['key'], t['path']), t) for t in lazydict.telemetry() ])
+		self.assertEqual(sorted(by), [
+			('<(a)->(b)>', 'c', lazydict.PATH_RECURSIVE),
+			('<(b)->(c)>', 'c', lazydict.PATH_RECURSIVE),
+			('<(x,y)->(sum,diff)>', 'diff', lazydict.PATH_BATCH),
+			('<(x,y)->(sum,diff)>', 'sum', lazydict.PATH_DIRECT),
+		])
+		t = by['<(x,y)->(sum,diff)>', 'diff', lazydict.PATH_BATCH]
+		self.assertEqual((t['calls'], t['records']), (1, 3))
+		self.assertEqual(sum([ n for bound, n in t['histogram'] ]), 1)
+		self.assertTrue(t['max'] <= t['histogram'][-1][0])
+
+		e = ExampleLazyDict.extensions[1]
+		self.assertEqual(len(e.telemetry()), 2)
+		e.telemetry_clear()
+		self.assertEqual(e.telemetry(), [])
+		self.assertEqual(len(lazydict.telemetry()), 2)
+
+	def test_histogram(self):
+		"""Test the latency buckets, including of calls too quick to time."""
+		t = lazydict.Telemetry()
+		for seconds in (0.0, 0.9, 1e-7, 3.0):
+			t.add(1, seconds)
+		self.assertEqual(t.d()['histogram'], [
+			[2.0**lazydict.HISTOGRAM_MIN_EXPONENT, 2],
+			[1.0, 1],
+			[4.0, 1],
+		])
+
+	def test_off(self):
+		"""Test that nothing is kept when telemetry is off."""
+		lazydict.TELEMETRY = False
+		ExampleLazyDict(x=1, y=2)['sum']
+		lazydict.prefetch([ ExampleLazyDict(x=x, y=1) for x in xrange(3) ], ('diff',))
+		self.assertEqual(lazydict.telemetry(), [])
+
+	def test_threads(self):
+		"""Test that no calls are lost when extending on many threads."""
+		n = 2000
+		out = []
+		dio.source([ ExampleLazyDict(x=x, y=1) for x in xrange(n) ],
+			out=dio.concurrent_extend(('sum',), workers=8, out=dio.buffer_out(out=out))
+		)
+		self.assertEqual(len(out), n)
+		t, = lazydict.telemetry()
+		self.assertEqual((t['calls'], t['records']), (n, n))
+		self.assertEqual(sum([ count for bound, count in t['histogram'] ]), n)
+
+
+class ResultCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		self.calls = calls = []
+
+		class x_lookup(lazydict.Extension):
+			source = ('host',)
+			target = ('ip',)
+			cache_size = 2
+			def __call__(self, host):
+				calls.append(host)
+				return 'ip of %s' % host,
+
+		class Host(lazydict.LazyDict):
+			extensions = [ x_lookup() ]
+
+		self.Host = Host
+		self.e = Host.extensions[0]
+
+	def test_shared_across_records(self):
+		for host in ('a', 'a', 'b', 'a'):
+			self.assertEqual(self.Host(host=host)['ip'], 'ip of %s' % host)
+
+		self.assertEqual(self.calls, ['a', 'b'])
+		info = self.e.cache_info()
+		self.assertEqual((info['hits'], info['misses']), (2, 2))
+
+	def test_lru_eviction(self):
+		for host in ('a', 'b', 'a', 'c', 'a', 'b'):
+			self.Host(host=host)['ip']
+
+		#c evicts b (a was used more recently), then b evicts c
+		self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
+		self.assertEqual(self.e.cache_info()['evictions'], 2)
+
+	def test_ttl(self):
+		self.e.cache_ttl = 0.05
+
+		self.Host(host='a')['ip']
+		self.Host(host='a')['ip']
+		time.sleep(0.1)
+		self.Host(host='a')['ip']
+
+		self.assertEqual(self.calls, ['a', 'a'])
+		self.assertEqual(self.e.cache_info()['expirations'], 1)
+
+	def test_uncached(self):
+		self.assertEqual(x_age().cache_info(), None)
+
+
+class CompactTestCase(unittest.TestCase):
+	def setUp(self):
+		self.out = []
+		dio.default_out = dio.buffer_out(out=self.out)
+
+	def test_mapping(self):
+		"""Test that a compact record acts like a dict."""
+		d = CompactExampleLazyDict(x=1, name='foo')
+		d['other'] = 2  #(not in the schema)
+		self.assertEqual(d, {'x':1, 'name':'foo', 'other':2})
+		self.assertEqual(sorted(d.keys()), ['name', 'other', 'x'])
+		self.assertEqual(len(d), 3)
+		self.assertEqual(d.get('y'), None)
+		self.assertEqual(d.pop('x'), 1)
+		self.assertRaises(KeyError, lambda: d['x'])
+		self.assertEqual(d.pop('x', 5), 5)
+		del d['other']
+		self.assertEqual(dict(d), {'name':'foo'})
+		self.assertEqual(d.copy(), d)
+		self.assertNotEqual(d, CompactExampleLazyDict(name='bar'))
+
+	def test_extensions(self):
+		"""Test that compact records are extended like the LazyDict."""
+		d = CompactExampleLazyDict(x=3, y=5, a=1)
+		self.assertEqual(d['sum'], 8)
+		self.assertEqual(dict(d)['diff'], -2)  #(query-optimized)
+		self.assertEqual(d['c'], 3)
+		self.assertTrue('name_copy' not in d)
+
+		d = CompactExampleLazyDict(x=3, y=5, _laziness=lazydict.LAZINESS_LOCKED)
+		self.assertTrue('sum' not in d)
+
+		ds = [ CompactExampleLazyDict(x=x, y=1) for x in xrange(3) ]
+		lazydict.prefetch(ds, ('sum',))
+		self.assertEqual([ d.get('sum') for d in ds ], [1, 2, 3])
+
+	def test_serialization(self):
+		"""Test that compact records round-trip as themselves."""
+		inn = [ CompactExampleLazyDict(x=1, y=2) ]
+
+		fout = cStringIO.StringIO()
+		dio.source(inn, out=dio.json_out(out=fout))
+		self.assertTrue('"eglib.CompactExampleLazyDict"' in fout.getvalue())
+		dio.json_in(inn=cStringIO.StringIO(fout.getvalue()))
+		self.assertEqual(type(self.out[0]), CompactExampleLazyDict)
+		self.assertEqual(self.out, inn)
+
+		d = cPickle.loads(cPickle.dumps(inn[0]))
+		self.assertEqual(d, inn[0])
+
+	def test_size(self):
+		"""Test that a compact record is much smaller than a dict."""
+		d = dict(name='foo', birthdate=0.0, x=1, y=2, a=3, age=4.0)
+		self.assertTrue(sys.getsizeof(CompactExampleLazyDict(d)) * 3 < sys.getsizeof(ExampleLazyDict(d)))
+
+	def test_intern_keys(self):
+		"""Test that json_in can share key strings between dicts."""
+		dio.json_in(inn=cStringIO.StringIO('{"key": 1}\n{"key": 2}\n'), intern_keys=True)
+		self.assertEqual(self.out, [ {'key':1}, {'key':2} ])
+		self.assertTrue(self.out[0].keys()[0] is self.out[1].keys()[0])
+
+
 if __name__=='__main__':
 	unittest.main()
@@ -6,7 +6,7 @@
 """unit tests"""
 
 
-import sys, itertools, unittest
+import sys, itertools, functools, unittest
 import dio
 
 import settings
@@ -72,6 +72,104 @@ class MinMaxTestCase(unittest.TestCase):
 			sorted([d[key] for d in results_expected]),
 		)
 
+	def test_top(self):
+		"""Test top() by two keys, with ties."""
+		input = [
+			{'a':1, 'b':1, 'i':0},
+			{'a':2, 'b':0, 'i':1},
+			{'a':2, 'b':1, 'i':2},
+			{'a':0, 'b':9, 'i':3},
+			{'a':2, 'b':1, 'i':4},
+		]
+
+		for kwargs, expected in (
+			(dict(), [2, 4, 1]),
+			(dict(ties='last'), [4, 2, 1]),
+			(dict(order='input'), [1, 2, 4]),
+			(dict(reverse=True), [3, 0, 1]),
+			(dict(keys=('a', ('b', True))), [1, 2, 4]),
+		):
+			results = []
+			kwargs.setdefault('keys', ('a', 'b'))
+			dio.source(input,
+				out=dio.top(3,
+					out=dio.buffer_out(
+						out=results
+					),
+					**kwargs
+				)
+			)
+			self.assertEqual([ d['i'] for d in results ], expected, repr(kwargs))
+
+	def test_top_large(self):
+		"""Test top() against sorting, on more data."""
+		import random
+		r = random.Random(0)
+		input = [ {'x':r.randint(0, 100)} for i in xrange(10000) ]
+
+		results = []
+		dio.source(input,
+			out=dio.top(100, ('x',),
+				out=dio.buffer_out(
+					out=results
+				)
+			)
+		)
+		self.assertEqual(results, sorted(input, key=lambda d: d['x'], reverse=True)[:100])
+
+
+class PartialTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+	def test_partial_combine(self):
+		"""Test that combining partial results of shards matches the whole."""
+		shards = [
+			[ {'x':1, 'y':2}, {'x':3} ],
+			[ {'x':5, 'y':10} ],
+			[ {'y':3} ],
+		]
+		for reducer in (dio.count, dio.sum_, dio.average):
+			#the whole
+			whole = []
+			dio.source(itertools.chain(*shards),
+				out=reducer(out=dio.buffer_out(out=whole))
+			)
+
+			#the shards, combined
+			partials = []
+			for shard in shards:
+				dio.source(shard,
+					out=reducer(partial=True, out=dio.buffer_out(out=partials))
+				)
+			combined = []
+			dio.source(partials,
+				out=reducer(combine=True, out=dio.buffer_out(out=combined))
+			)
+
+			self.assertEqual(sorted(combined), sorted(whole))
+
+	def test_partial_state(self):
+		"""Test the partial state of average."""
+		dio.source([ {'x':1}, {'x':2}, {'x':3} ],
+			out=dio.average(partial=True)
+		)
+		self.assertEqual(self.out, [ {'x': {'count':3, 'sum':6, 'sum_sq':14}} ])
+
+	def test_parallel(self):
+		"""Test partial reducers in parallel, combined afterwards."""
+		dio.source(( {'x':x} for x in xrange(1000) ),
+			out=dio.parallel(functools.partial(dio.average, partial=True), workers=3,
+				out=dio.average(combine=True)
+			)
+		)
+		self.assertEqual(self.out, [ {'x': 499.5} ])
+
 
 if __name__=='__main__':
 	unittest.main()
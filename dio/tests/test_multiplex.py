@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""unit tests"""
+
+
+import os, threading, unittest
+import dio
+from dio import codec
+from dio.multiplex import multiplex_in
+
+import settings
+from eglib import ExampleLazyDict
+
+
+def writer(fd, lines):
+	"""Start a thread that writes the lines to fd, and then closes it."""
+	def write():
+		for line in lines:
+			os.write(fd, line)
+		os.close(fd)
+	t = threading.Thread(target=write)
+	t.start()
+	return t
+
+
+class MultiplexTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+	def test_streams(self):
+		"""Test many streams, in pieces, with per-stream order, types, and errors."""
+		n = 50
+		pipes = [ os.pipe() for i in xrange(n) ]
+		threads = []
+		for i, (r, w) in enumerate(pipes):
+			text = ''.join([ '{"i": %d, "j": %d}\n' % (i, j) for j in xrange(100) ])
+			text += '{"1": "eglib.ExampleLazyDict", "__class__": "__types__"}\n{"x": 1, "y": 2, "__class__": 1}\n'
+			if i == 0:
+				text += 'not json\n'
+			text += '{"i": %d, "j": "last"}' % i  #(no newline at the end)
+			threads.append(writer(w, [ text[k:k+77] for k in xrange(0, len(text), 77) ]))
+
+		multiplex_in([ r for r, w in pipes ], key='stream', chunk_size=100)
+		for t in threads:
+			t.join()
+		for r, w in pipes:
+			os.close(r)
+
+		self.assertEqual(len(self.err), 1)
+		self.assertEqual(len(self.out), n * 102)
+		for i in xrange(n):
+			ds = [ d for d in self.out if d['stream'] == i ]
+			self.assertEqual([ d.get('j') for d in ds ], range(100) + [None, 'last'])
+			self.assertTrue(isinstance(ds[100], ExampleLazyDict))
+			self.assertEqual(ds[100]['sum'], 3)
+			self.assertTrue(all([ d.get('i', i) == i for d in ds ]))
+
+	def test_concurrent(self):
+		"""Test that a stalled stream doesn't hold up the others."""
+		slow_r, slow_w = os.pipe()
+		fast_r, fast_w = os.pipe()
+		os.write(slow_w, '{"slow": 1}\n')
+
+		#the slow stream is only finished once all of the fast stream is in
+		timer = threading.Timer(10, os.close, (slow_w,))  #(rather than hanging, if broken)
+		timer.start()
+		@dio.processor
+		def watch(out=None, err=None):
+			while True:
+				d = yield
+				out.send(d)
+				if d.get('fast') == 999 and timer.isAlive():
+					timer.cancel()
+					os.close(slow_w)
+
+		t = writer(fast_w, [ '{"fast": %d}\n' % i for i in xrange(1000) ])
+		multiplex_in([slow_r, fast_r], raw=True, out=watch())
+		t.join()
+		os.close(slow_r)
+		os.close(fast_r)
+
+		self.assertEqual(len(self.out), 1001)
+		self.assertTrue(isinstance(self.out[-1], codec.RawRecord))
+		self.assertEqual(sorted([ d.get('fast', -1) for d in self.out ]), range(-1, 1000))
+
+
+if __name__=='__main__':
+	unittest.main()
@@ -6,11 +6,14 @@
 """unit tests"""
 
 
-import sys, time, string, cStringIO, unittest
+import sys, errno, time, string, itertools, functools, threading, cStringIO, tempfile, unittest
 import dio
 import dio.coreutils
+import dio.batch
+from dio import lazydict, pipeline
 
 import settings
+from eglib import ExampleLazyDict
 
 
 class ProcessorTestCase(unittest.TestCase):
@@ -232,6 +235,268 @@ class ProcessorTestCase(unittest.TestCase):
 			[],
 		)
 
+	def test_type_ids(self):
+		"""Test serialization with compact type ids, for each format."""
+		inn = [ ExampleLazyDict(x=1, y=2), {'z':3}, ExampleLazyDict(x=4, y=5) ]
+
+		for sink, source in (
+			(dio.json_out, dio.json_in),
+			(dio.pickle_out, dio.pickle_in),
+			(dio.repr_out, dio.repr_in),
+		):
+			del self.out[:]
+
+			fout = cStringIO.StringIO()
+			dio.source(inn, out=sink(out=fout, type_ids=True))
+			dio.source([], out=sink(out=fout, type_ids=True))
+			fin = cStringIO.StringIO(fout.getvalue())
+			source(inn=fin)
+
+			self.assertEqual(self.out, inn)
+			self.assertEqual([ type(d) for d in self.out ], [ ExampleLazyDict, dict, ExampleLazyDict ])
+			self.assertEqual(self.out[0]['sum'], 3)
+
+		#the class name only appears once, in the header
+		self.assertEqual(fout.getvalue().count('ExampleLazyDict'), 1)
+
+	def test_instrument(self):
+		"""Test per-stage statistics."""
+		stats = []
+		dio.instrument.enable(out=dio.buffer_out(out=stats))
+		try:
+			dio.source(({'i':i} for i in xrange(10)),
+				out=dio.filter(lambda d: d['i'] / (d['i'] % 5) >= 0,
+					out=dio.batch.batch(4,
+						out=dio.batch.unbatch()
+					)
+				)
+			)
+		finally:
+			dio.instrument.disable()
+		dio.instrument.emit()
+
+		self.assertEqual(len(self.out), 8)
+		self.assertEqual(len(self.err), 2)
+
+		by_stage = dict([ (d['stage'], d) for d in stats ])
+		self.assertEqual(sorted(by_stage), ['dio.batch.batch', 'dio.batch.unbatch', 'dio.filter', 'dio.source'])
+		self.assertEqual((by_stage['dio.source']['in'], by_stage['dio.source']['out']), (0, 10))
+		self.assertEqual((by_stage['dio.filter']['in'], by_stage['dio.filter']['out'], by_stage['dio.filter']['errors']), (10, 8, 2))
+		self.assertEqual((by_stage['dio.batch.batch']['in'], by_stage['dio.batch.batch']['out']), (8, 8))
+		for d in stats:
+			self.assertTrue(0 <= d['max_latency'] <= d['wall'])
+
+		#nothing is left, and nothing more is instrumented
+		dio.filter(lambda d: True)
+		self.assertEqual(dio.instrument.report(), [])
+
+	def test_json_raw(self):
+		"""Test raw records, which are written as is unless modified."""
+		lines = [
+			'{"x":1,   "y":2}\n',
+			'{"x":1,   "y":2}\n',
+			'\n',
+			'{"x":2, "l":[1]}\n',
+			'{"x":3}\n',
+			'{"x": 3, "y": 5, "__class__": "eglib.ExampleLazyDict"}\n',
+		]
+
+		dio.json_in(inn=lines, raw=True)
+		self.assertEqual([ type(d) for d in self.out ], [ dio.codec.RawRecord ] * 4 + [ ExampleLazyDict ])
+		self.assertEqual(self.out[0], self.out[1])
+		self.assertEqual(self.out[0], {'x':1, 'y':2})
+		self.assertNotEqual(self.out[0], self.out[3])
+
+		self.out[1]['y'] = 3
+		self.out[2]['l'].append(2)  #(modified in place)
+		self.assertEqual(self.out[3]['x'], 3)  #(only looked at)
+
+		fout = cStringIO.StringIO()
+		dio.source(self.out, out=dio.json_out(out=fout))
+		self.assertEqual(fout.getvalue().splitlines(), [
+			'{"x":1,   "y":2}',
+			'{"y": 3, "x": 1}',
+			'{"x": 2, "l": [1, 2]}',
+			'{"x":3}',
+			'{"y": 5, "x": 3, "__class__": "eglib.ExampleLazyDict"}',
+		])
+
+		#other sinks get plain dicts
+		fout = cStringIO.StringIO()
+		dio.source(self.out[:1], out=dio.pickle_out(out=fout, type_ids=True))
+		del self.out[:]
+		dio.pickle_in(inn=cStringIO.StringIO(fout.getvalue()))
+		self.assertEqual(self.out, [ {'x':1, 'y':2} ])
+		self.assertEqual(type(self.out[0]), dict)
+
+	def test_threaded_io(self):
+		"""Test reading ahead and writing behind, including errors and EPIPE."""
+		ds = [ {'i':i} for i in xrange(1000) ] + [ ExampleLazyDict(x=1, y=2) ]
+
+		for sink, source in ((dio.json_out, dio.json_in), (dio.pickle_out, dio.pickle_in)):
+			for type_ids in (False, True):
+				fout = cStringIO.StringIO()
+				dio.source(ds, out=sink(out=fout, type_ids=type_ids))
+				expected = fout.getvalue()
+
+				fout = cStringIO.StringIO()
+				dio.source(ds, out=sink(out=fout, type_ids=type_ids, write_behind=True))
+				self.assertEqual(fout.getvalue(), expected)
+
+				del self.out[:]
+				source(inn=cStringIO.StringIO(expected), read_ahead=True)
+				self.assertEqual(self.out, ds)
+				self.assertTrue(isinstance(self.out[-1], ExampleLazyDict))
+
+		#stopping early
+		del self.out[:]
+		dio.json_in(inn=('{"i": %d}\n' % i for i in itertools.count()), read_ahead=True,
+			out=dio.coreutils.head(3)
+		)
+		self.assertEqual(self.out, [ {'i':0}, {'i':1}, {'i':2} ])
+
+		#errors reading, in order
+		del self.out[:]
+		self.assertRaises(ValueError, dio.json_in, inn=['{"i": 0}\n', 'nope\n', '{"i": 1}\n'], read_ahead=True)
+		self.assertEqual(self.out, [ {'i':0} ])
+
+		#errors writing
+		class BrokenPipe(object):
+			def __init__(self, errno):
+				self.errno = errno
+				self.writes = 0
+			def write(self, s):
+				self.writes += 1
+				raise IOError(self.errno, 'broken')
+		fout = BrokenPipe(errno.EPIPE)
+		dio.source(itertools.repeat({'i':0}), out=dio.json_out(out=fout, buffer_size=0, write_behind=True))
+		self.assertEqual(fout.writes, 1)
+		self.assertRaises(IOError, dio.source, itertools.repeat({'i':0}), out=dio.json_out(out=BrokenPipe(errno.EIO), buffer_size=0, write_behind=True))
+
+	def test_json_file_in(self):
+		"""Test parallel parsing of a file, ordered and not, with type ids."""
+		inn = [ ExampleLazyDict(x=i, y=1) if i % 7 == 0 else {'i':i, 's':'x'*(i%13)} for i in xrange(200) ]
+
+		f = tempfile.NamedTemporaryFile(suffix='.json')
+		dio.source(inn, out=dio.json_out(out=f, type_ids=True))
+		f.write('\n')  #(blank lines are skipped)
+		f.flush()
+
+		for workers in (0, 3):
+			for ordered in (True, False):
+				del self.out[:]
+				dio.json_file_in(f.name, workers=workers, ordered=ordered, chunk_size=100)
+				if not ordered:
+					self.out.sort(key=lambda d: d.get('i', d.get('x')))
+				self.assertEqual(self.out, inn)
+				self.assertEqual([ type(d) for d in self.out[::7] ], [ ExampleLazyDict ] * 29)
+		f.close()
+
+		#an empty file
+		f = tempfile.NamedTemporaryFile(suffix='.json')
+		del self.out[:]
+		dio.json_file_in(f.name)
+		self.assertEqual(self.out, [])
+		f.close()
+
+	def test_json_file_in_concatenated(self):
+		"""Test parallel parsing of files concatenated, which reuse type ids."""
+		f = tempfile.NamedTemporaryFile(suffix='.json')
+		for name in ('eglib.ExampleLazyDict', 'dio.lazydict.LazyDict') * 5:
+			f.write('{"1": "%s", "__class__": "__types__"}\n' % name)
+			for i in xrange(50):
+				f.write('{"i": %d, "c": "%s", "__class__": 1}\n{"i": %d}\n' % (i, name, i))
+		f.flush()
+
+		for workers in (0, 3):
+			for ordered in (True, False):
+				del self.out[:]
+				dio.json_file_in(f.name, workers=workers, ordered=ordered, chunk_size=100)
+				self.assertEqual(len(self.out), 1000)
+				for d in self.out:
+					if 'c' in d:
+						self.assertEqual(dio.class_name(type(d)), d['c'])
+					else:
+						self.assertTrue(type(d) is dict)
+		f.close()
+
+	def test_window(self):
+		"""Test that json_file_in's feed of work to the pool holds back."""
+		window = dio._Window(xrange(10), 3)
+		taken = []
+		def take():
+			for x in window:
+				taken.append(x)
+		t = threading.Thread(target=take)
+		t.start()
+		time.sleep(0.1)
+		self.assertEqual(taken, [0, 1, 2])
+		window.release()
+		window.release()
+		time.sleep(0.1)
+		self.assertEqual(taken, [0, 1, 2, 3, 4])
+		window.stop()
+		t.join()
+		self.assertEqual(taken, [0, 1, 2, 3, 4])
+
+	def test_register_class(self):
+		"""Test registering a class under a name."""
+		class Local(dio.lazydict.LazyDict):
+			pass
+		dio.register_class(Local, 'test.Local')
+
+		fout = cStringIO.StringIO()
+		dio.source([ Local(x=1) ], out=dio.json_out(out=fout))
+		self.assertTrue('"test.Local"' in fout.getvalue())
+
+		dio.json_in(inn=cStringIO.StringIO(fout.getvalue()))
+		self.assertEqual(type(self.out[0]), Local)
+
+	def test_json_out_buffering(self):
+		"""Test that json_out coalesces writes, and writes everything by close."""
+
+		class Out(object):
+			def __init__(self):
+				self.writes = []
+			def write(self, s):
+				self.writes.append(s)
+
+		fout = Out()
+		dio.source(( {'x':x} for x in xrange(1000) ),
+			out=dio.json_out(out=fout, buffer_size=1000)
+		)
+
+		self.assertTrue(1 < len(fout.writes) < 100)
+		self.assertEqual(''.join(fout.writes), ''.join([ '{"x": %d}\n' % x for x in xrange(1000) ]))
+
+	def test_json_out_interactive(self):
+		"""Test that json_out writes each dict right away to a terminal."""
+
+		class Terminal(object):
+			def __init__(self):
+				self.writes = []
+			def write(self, s):
+				self.writes.append(s)
+			def isatty(self):
+				return True
+
+		fout = Terminal()
+		sink = dio.json_out(out=fout)
+		sink.send({'x':1})
+		self.assertEqual(fout.writes, [ '{"x": 1}\n' ])
+
+	def test_json_out_epipe_on_close(self):
+		"""Test that a broken pipe while writing out the buffer on close is quiet."""
+		import errno
+
+		class BrokenPipe(object):
+			def write(self, s):
+				raise IOError(errno.EPIPE, 'Broken pipe')
+
+		sink = dio.json_out(out=BrokenPipe())
+		sink.send({'x':1})
+		sink.close()
+
 	def test_apply(self):
 		"""Test dio.apply."""
 
@@ -278,6 +543,188 @@ class ProcessorTestCase(unittest.TestCase):
 			for k in keys:
 				self.assertTrue(k in d)  #and specifically those keys
 
+	def test_prefetch(self):
+		"""Test dio.prefetch, with a batched extension."""
+
+		#--- a LazyDict with an extension that records its batches
+
+		batches = []
+
+		class x_square(lazydict.Extension):
+			source = ('x',)
+			target = ('square',)
+			def __call__(self, x):
+				return x*x,
+			def call_batch(self, sources):
+				batches.append(len(sources))
+				return lazydict.Extension.call_batch(self, sources)
+
+		class Squarable(lazydict.LazyDict):
+			extensions = [ x_square() ]
+
+
+		#--- run it
+
+		inn = [ Squarable(x=x) for x in xrange(10) ] + [ {'x':10} ]
+		dio.source(inn, out=dio.prefetch(('square',), batch_size=4))
+
+
+		#--- inspect output
+
+		self.assertEqual(batches, [4, 4, 2])
+		self.assertEqual(self.out, inn)  #(same order)
+		self.assertEqual(
+			[ dict.get(d, 'square') for d in self.out ],
+			[ x*x for x in xrange(10) ] + [ None ],
+		)
+
+	def test_prefetch_chain(self):
+		"""Test dio.prefetch through a chain of extensions."""
+		inn = [ ExampleLazyDict(a=a) for a in xrange(5) ]
+		dio.source(inn, out=dio.prefetch(('c',)))
+		self.assertEqual([ dict.get(d, 'c') for d in self.out ], range(2, 7))
+
+	def test_concurrent_extend(self):
+		"""Test dio.concurrent_extend, ordered and not."""
+
+		#--- a LazyDict with a slow extension
+
+		delay = 0.05
+
+		class x_slow(lazydict.Extension):
+			source = ('x',)
+			target = ('slow',)
+			def __call__(self, x):
+				time.sleep(delay)
+				return x,
+
+		class Slow(lazydict.LazyDict):
+			extensions = [ x_slow() ]
+
+
+		#--- run it
+
+		n = 16
+		for ordered in (True, False):
+			del self.out[:]
+
+			t = time.time()
+			dio.source(( Slow(x=x) for x in xrange(n) ),
+				out=dio.concurrent_extend(('slow',), workers=8, window=8, ordered=ordered)
+			)
+			t = time.time() - t
+
+
+			#--- inspect output
+
+			self.assertTrue(t < n*delay/2, "extensions did not overlap")
+			results = [ dict.get(d, 'slow') for d in self.out ]
+			if not ordered:
+				results.sort()
+			self.assertEqual(results, range(n))
+		self.assertEqual(self.err, [])
+
+	def test_parallel(self):
+		"""Test dio.parallel, ordered and not."""
+		n = 1000
+		for ordered in (True, False):
+			del self.out[:]
+
+			dio.source(( ExampleLazyDict(x=x, y=x) for x in xrange(n) ),
+				out=dio.parallel(
+					lambda out, err: dio.filter(lambda d: d['x'] % 100,
+						out=dio.tidy(('sum',), out=out, err=err),
+						err=err,
+					),
+					workers=3, ordered=ordered, chunk_size=7,
+				)
+			)
+
+			results = [ d['sum'] for d in self.out ]
+			if not ordered:
+				results.sort()
+			self.assertEqual(results, [ 2*x for x in xrange(n) if x % 100 ])
+			self.assertTrue(isinstance(self.out[0], ExampleLazyDict))
+		self.assertEqual(self.err, [])
+
+	def test_parallel_errors(self):
+		"""Test that errors in dio.parallel workers are sent to err."""
+		dio.source([ {'x':1}, {}, {'x':2} ],
+			out=dio.parallel(functools.partial(dio.filter, lambda d: d['x']), workers=2, chunk_size=1)
+		)
+
+		self.assertEqual(self.out, [ {'x':1}, {'x':2} ])
+		self.assertEqual(len(self.err), 1)
+		self.assertEqual(self.err[0]['exception_type'], 'KeyError')
+
+	def test_parallel_failure(self):
+		"""Test that a sub-pipeline raising in dio.parallel stops it."""
+		@dio.processor
+		def fail_on_100(out=None, err=None):
+			while True:
+				d = yield
+				if d['x'] == 100:
+					raise ValueError('bad record')
+				out.send(d)
+
+		for ordered in (True, False):
+			del self.out[:]
+			self.assertRaises(ValueError, dio.source, ( {'x':x} for x in xrange(200) ),
+				out=dio.parallel(fail_on_100, workers=2, ordered=ordered, chunk_size=1)
+			)
+			xs = [ d['x'] for d in self.out ]
+			self.assertTrue(100 not in xs)
+			self.assertTrue(len(xs) < 199)  #(nothing goes missing silently)
+			if ordered:
+				self.assertEqual(xs, range(100))
+		self.assertEqual(self.err, [])
+
+	def test_parallel_reducer(self):
+		"""Test that dio.parallel closes stateful sub-pipelines."""
+		dio.source(( {'x':x} for x in xrange(100) ),
+			out=dio.parallel(dio.coreutils.wc, workers=2, chunk_size=10)
+		)
+		self.assertEqual(sum(d['count'] for d in self.out), 100)
+
+	def test_parallel_early_termination(self):
+		"""Test dio.parallel followed by coreutils.head."""
+		dio.source(( {'x':x} for x in itertools.count() ),
+			out=dio.parallel(dio.identity, workers=2,
+				out=dio.coreutils.head(5)
+			)
+		)
+		self.assertEqual(self.out, [ {'x':x} for x in xrange(5) ])
+
+	def test_sort(self):
+		"""Test dio.sort by several keys, in different directions, stably."""
+		inn = [
+			{'a':1, 'b':'x', 'i':0},
+			{'a':2, 'b':'y', 'i':1},
+			{'a':1, 'b':'y', 'i':2},
+			{'a':2, 'b':'y', 'i':3},
+			{'a':1, 'b':'x', 'i':4},
+		]
+		expected = [ 2, 0, 4, 1, 3 ]  #a ascending, then b descending, then input order
+
+		for buffer_size in (100, 2):  #(the latter spills to temporary files)
+			del self.out[:]
+			dio.source(inn,
+				out=dio.coreutils.sort(['a', ('b', True)], buffer_size=buffer_size)
+			)
+			self.assertEqual([ d['i'] for d in self.out ], expected)
+
+		del self.out[:]
+		dio.source(inn, out=dio.coreutils.sort(['a', ('b', True)], reverse=True))
+		self.assertEqual([ d['i'] for d in self.out ], [ 1, 3, 0, 4, 2 ])  #a descending, then b ascending
+
+	def test_sort_spill_lazydict(self):
+		"""Test that dio.sort spilling to temporary files keeps LazyDict classes."""
+		dio.source(( ExampleLazyDict(x=x, y=1) for x in (3, 1, 4, 1, 5, 9, 2, 6) ),
+			out=dio.coreutils.sort(['sum'], buffer_size=3)
+		)
+		self.assertEqual([ d['x'] for d in self.out ], [ 1, 1, 2, 3, 4, 5, 6, 9 ])
+		self.assertTrue(isinstance(self.out[0], ExampleLazyDict))
+
 	def test_uniq(self):
 		"""Test dio.uniq."""
 
@@ -317,5 +764,50 @@ class ProcessorTestCase(unittest.TestCase):
 		)
 
 
+class PipelineSpecTestCase(unittest.TestCase):
+	def setUp(self):
+		"""Send out/err to inspectable accumulators rather than the screen."""
+		self.out = []
+		self.err = []
+
+		dio.default_out = dio.buffer_out(out=self.out)
+		dio.default_err = dio.buffer_out(out=self.err)
+
+	def test_parse(self):
+		"""Test parsing a pipeline as one string, and as tokens."""
+		expected = [('filter', ['%x', '-gt', '10']), ('tidy', ['x']), ('sort', ['x'])]
+		self.assertEqual(pipeline.parse(['filter %x -gt 10 | tidy x | dio.sort x']), expected)
+		self.assertEqual(pipeline.parse(['filter', '%x', '-gt', '10', '|', 'tidy', 'x', '|', 'sort', 'x']), expected)
+		self.assertTrue(pipeline.is_raw(pipeline.parse(['filter %x -gt 1 | uniq'])))
+		self.assertFalse(pipeline.is_raw(expected))
+
+		for args in (['bogus'], ['tidy x | | sort x'], ['head x'], ['min 1'], ['filter %x -gt']):
+			self.assertRaises(pipeline.PipelineError, lambda: pipeline.build(pipeline.parse(args)))
+
+	def test_run(self):
+		"""Test running a pipeline, including stages that send when closed."""
+		inn = cStringIO.StringIO('''
+{"x": 5, "y": "a"}
+{"x": 20, "y": "b"}
+{"x": 12, "y": "c"}
+{"x": 12, "y": "c"}
+''')
+		pipeline.run(['filter %x -gt 10 | uniq | tidy x | sort --reverse x | sum'], inn=inn)
+		self.assertEqual(self.out, [{"x": 32}])
+
+		#closed even if the input fails partway
+		def failing():
+			yield '{"x": 1}\n'
+			yield '{"x": 2}\n'
+			raise IOError('broken')
+		del self.out[:]
+		try:
+			pipeline.run(['sort x'], inn=failing())
+		except IOError:
+			self.assertEqual(self.out, [{"x": 1}, {"x": 2}])
+		else:
+			self.fail('the error was not raised')
+
+
 if __name__=='__main__':
 	unittest.main()
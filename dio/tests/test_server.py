@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014, John A. Brunelle
+# All rights reserved.
+
+"""unit tests"""
+
+
+import os, json, shutil, tempfile, threading, subprocess, cStringIO, unittest
+from dio import server, instrument
+
+import settings
+
+
+def request(args, input):
+	"""Return the request of a client, as server.handle reads it."""
+	s = '\0'.join(args)
+	return cStringIO.StringIO('%d\n%s%s' % (len(s), s, input))
+
+def replies(s):
+	"""Return the list of (channel, data) in the replies s."""
+	f = cStringIO.StringIO(s)
+	results = []
+	while True:
+		header = f.readline()
+		if not header:
+			break
+		channel, n = header.split()
+		results.append((channel, f.read(int(n))))
+	return results
+
+
+class ServerTestCase(unittest.TestCase):
+	def test_handle(self):
+		"""Test the protocol, including errors."""
+		out = cStringIO.StringIO()
+		status = server.handle(request(['filter %x -gt 1 | tidy x'], '{"x": 1}\n{"x": 2, "y": 3}\n'), out)
+		self.assertEqual(status, 0)
+		self.assertEqual(replies(out.getvalue()), [('o', '{"x": 2}\n')])
+
+		out = cStringIO.StringIO()
+		status = server.handle(request(['tidy x | bogus'], ''), out)
+		self.assertEqual(status, 2)
+		self.assertEqual([ c for c, data in replies(out.getvalue()) ], ['e'])
+
+		out = cStringIO.StringIO()
+		status = server.handle(request(['filter', '%x', '-gt', '1'], '{"y": 1}\n'), out)
+		self.assertEqual(status, 0)
+		self.assertEqual([ c for c, data in replies(out.getvalue()) ], ['e'])  #(the KeyError)
+
+		self.assertEqual(server.handle(cStringIO.StringIO(''), out), None)
+
+	def test_stats(self):
+		"""Test that each request's statistics are its own, and then dropped."""
+		instrument.enable()
+		try:
+			for n in (3, 5):
+				out = cStringIO.StringIO()
+				input = '{"x": 1}\n' * n
+				self.assertEqual(server.handle(request(['tidy x'], input), out), 0)
+				stats = [ json.loads(data) for c, data in replies(out.getvalue()) if c == 'e' ]
+				by_stage = dict([ (d['stage'], d) for d in stats ])
+				self.assertEqual(by_stage['dio.tidy']['in'], n)
+				self.assertEqual(len(stats), 4)  #(the source, the sinks, and tidy)
+				self.assertEqual(instrument.report(), [])
+			self.assertEqual(instrument._stats, [])
+		finally:
+			instrument.disable()
+
+	def test_client(self):
+		"""Test bin/dio forwarding to the daemon, and falling back without it."""
+		tmpdir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(tmpdir, 'socket')
+			env = dict(os.environ)
+			env['DIO_SOCKET'] = path
+
+			def run(args, input):
+				p = subprocess.Popen(['dio'] + args, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+				stdout, stderr = p.communicate(input)
+				return p.returncode, stdout, stderr
+
+			input = ''.join([ '{"x": %d}\n' % (i % 10) for i in xrange(10000) ])
+
+			#no daemon yet
+			self.assertEqual(run(['filter %x -eq 3 | wc'], input), (0, '{"count": 1000}\n', ''))
+
+			s = server.Server(path)
+			self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+			t = threading.Thread(target=s.serve_forever)
+			t.start()
+			try:
+				self.assertEqual(run(['filter %x -eq 3 | wc'], input), (0, '{"count": 1000}\n', ''))
+				self.assertEqual(run(['head 2'], input), (0, '{"x": 0}\n{"x": 1}\n', ''))
+				status, stdout, stderr = run(['bogus'], input)
+				self.assertEqual((status, stdout), (2, ''))
+				self.assertTrue(stderr.startswith('dio: unknown stage'))
+
+				#a daemon that's not ours (though root can still use it)
+				os.chmod(path, 0)
+				self.assertEqual(run(['filter %x -eq 3 | wc'], input), (0, '{"count": 1000}\n', ''))
+			finally:
+				s.shutdown()
+				t.join()
+				s.server_close()
+			self.assertFalse(os.path.exists(path))
+		finally:
+			shutil.rmtree(tmpdir)
+
+
+if __name__=='__main__':
+	unittest.main()